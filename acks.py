@@ -0,0 +1,233 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+import urllib.request
+from typing import Callable, Dict, List, Optional
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+from failures import normalize_phone
+
+# WhatsApp Web ack levels
+ACK_STATUSES = {-1: 'error', 0: 'pending', 1: 'sent', 2: 'delivered', 3: 'read', 4: 'played'}
+# Levels that can still move on; a message is polled until it reaches read/played or gives up
+OPEN_ACKS = (0, 1, 2)
+
+
+def ack_status(ack: Optional[int]) -> str:
+    return ACK_STATUSES.get(ack, 'unknown')
+
+
+def message_id_of(value) -> Optional[str]:
+    """Serialized message id from a send result or ack event, whichever shape the client used."""
+    if isinstance(value, dict):
+        if 'id' in value and not value.get('_serialized'):
+            return message_id_of(value['id'])
+        return value.get('_serialized')
+    return value or None
+
+
+class AckTracker:
+    """SQLite index of sent messages and their latest ack, with webhook notifications on every change.
+
+    Phone numbers are stored normalised (see failures.normalize_phone), so any spelling finds them.
+    """
+
+    def __init__(self, db_path: str = "acks.db", webhook_url: Optional[str] = None,
+                 webhook_timeout: float = 5.0, webhook_attempts: int = 3, max_age: float = 86400.0):
+        self.db_path = db_path
+        self.webhook_url = webhook_url
+        self.webhook_timeout = webhook_timeout
+        self.webhook_attempts = webhook_attempts
+        self.max_age = max_age
+        self.webhook_counts = {'sent': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._webhooks = queue.Queue(maxsize=10000)
+        self._webhook_thread = None
+        # Session worker processes share this file, like the failure store
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS acks (
+                    message_id TEXT PRIMARY KEY,
+                    phone_number TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    session TEXT,
+                    ack INTEGER,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    sent_at REAL,
+                    delivered_at REAL,
+                    read_at REAL,
+                    polls INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_acks_phone ON acks (phone_number, created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_acks_open ON acks (session, ack, updated_at)")
+
+    def track(self, message_id: str, phone_number: str, kind: str, ack: Optional[int],
+              session: Optional[str] = None):
+        """Index a message the client accepted; its first ack counts as a change."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO acks (message_id, phone_number, kind, session, ack, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, NULL, 'pending', ?, ?)
+                ON CONFLICT (message_id) DO NOTHING
+            """, (message_id, normalize_phone(phone_number), kind, session, now, now))
+        if ack is not None:
+            self.update(message_id, ack)
+
+    def update(self, message_id: str, ack: int) -> bool:
+        """Record a new ack level; acks only move forward, except to error. Returns True if it changed."""
+        now = time.time()
+        status = ack_status(ack)
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT * FROM acks WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None or row['ack'] == ack or (row['ack'] is not None and 0 <= ack < row['ack']):
+                return False
+            self._conn.execute("""
+                UPDATE acks SET ack = ?, status = ?, updated_at = ?,
+                    sent_at = CASE WHEN ? >= 1 THEN COALESCE(sent_at, ?) ELSE sent_at END,
+                    delivered_at = CASE WHEN ? >= 2 THEN COALESCE(delivered_at, ?) ELSE delivered_at END,
+                    read_at = CASE WHEN ? >= 3 THEN COALESCE(read_at, ?) ELSE read_at END
+                WHERE message_id = ?
+            """, (ack, status, now, ack, now, ack, now, ack, now, message_id))
+            row = self._conn.execute("SELECT * FROM acks WHERE message_id = ?", (message_id,)).fetchone()
+        sentry_sdk.logger.info(f"Message {message_id} is now {status}")
+        self._notify(dict(row))
+        return True
+
+    def on_ack(self, event: Dict[str, any]):
+        """Callback for the client's onAck event."""
+        try:
+            message_id = message_id_of(event)
+            if message_id is not None and event.get('ack') is not None:
+                self.update(message_id, int(event['ack']))
+        except Exception as e:
+            capture_exception(e)
+
+    def get(self, message_id: str) -> Optional[Dict[str, any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM acks WHERE message_id = ?", (message_id,)).fetchone()
+        return dict(row) if row else None
+
+    def query(self, phone_number: Optional[str] = None, status: Optional[str] = None,
+              limit: int = 100) -> List[Dict[str, any]]:
+        clauses, params = [], []
+        if phone_number:
+            clauses.append("phone_number = ?")
+            params.append(normalize_phone(phone_number))
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM acks {where} ORDER BY created_at DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM acks GROUP BY status").fetchall()
+        counts = {row['status']: row['n'] for row in rows}
+        total = sum(counts.values())
+        delivered = sum(counts.get(s, 0) for s in ('delivered', 'read', 'played'))
+        return {
+            'counts': counts,
+            'delivery_rate': round(delivered / total, 4) if total else None,
+            'webhooks': dict(self.webhook_counts),
+        }
+
+    def start_polling(self, poll: Callable[[str], Optional[int]], is_ready: Callable[[], bool],
+                      session: Callable[[], Optional[str]], interval: float = 30.0, batch_size: int = 50):
+        """Fallback for clients that do not emit ack events: ask for the ack of open messages.
+
+        Only messages sent by session() are polled; other sessions' workers poll their own.
+        """
+        def loop():
+            while not self._stop_event.wait(interval):
+                try:
+                    if is_ready():
+                        self.poll_open(poll, session(), batch_size)
+                except Exception as e:
+                    capture_exception(e)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=loop, name="ack-poll", daemon=True)
+        self._thread.start()
+
+    def poll_open(self, poll: Callable[[str], Optional[int]], session: Optional[str] = None,
+                  batch_size: int = 50) -> int:
+        """Refresh the least recently updated open messages of a session; returns how many changed."""
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT message_id FROM acks
+                WHERE session IS ? AND (ack IS NULL OR ack IN ({','.join('?' * len(OPEN_ACKS))}))
+                    AND created_at >= ?
+                ORDER BY updated_at LIMIT ?
+            """, (session, *OPEN_ACKS, cutoff, batch_size)).fetchall()
+        changed = 0
+        for row in rows:
+            try:
+                ack = poll(row['message_id'])
+                if ack is not None and self.update(row['message_id'], ack):
+                    changed += 1
+            except Exception as e:
+                # One bad message must not stall the others
+                capture_exception(e)
+            # Count the attempt and move it to the back of the line, whatever happened
+            with self._lock, self._conn:
+                self._conn.execute("UPDATE acks SET polls = polls + 1, updated_at = ? WHERE message_id = ?",
+                                   (time.time(), row['message_id']))
+        return changed
+
+    def _notify(self, record: Dict[str, any]):
+        if not self.webhook_url:
+            return
+        if self._webhook_thread is None or not self._webhook_thread.is_alive():
+            self._webhook_thread = threading.Thread(target=self._webhook_loop, name="ack-webhook", daemon=True)
+            self._webhook_thread.start()
+        try:
+            self._webhooks.put_nowait(record)
+        except queue.Full:
+            self.webhook_counts['failed'] += 1
+
+    def _webhook_loop(self):
+        while True:
+            record = self._webhooks.get()
+            if record is None:
+                return
+            body = json.dumps({'event': 'ack', **record}).encode('utf-8')
+            for attempt in range(self.webhook_attempts):
+                try:
+                    request = urllib.request.Request(self.webhook_url, data=body,
+                                                     headers={'Content-Type': 'application/json'})
+                    with urllib.request.urlopen(request, timeout=self.webhook_timeout):
+                        pass
+                    self.webhook_counts['sent'] += 1
+                    break
+                except Exception as e:
+                    if attempt == self.webhook_attempts - 1:
+                        capture_exception(e)
+                        self.webhook_counts['failed'] += 1
+                    else:
+                        time.sleep(2 ** attempt)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self._webhook_thread and self._webhook_thread.is_alive():
+            self._webhooks.put(None)
+            self._webhook_thread.join(timeout=self.webhook_timeout)
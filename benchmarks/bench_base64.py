@@ -0,0 +1,92 @@
+"""Compare peak RSS and encode time of the streaming base64 encoder against the old path.
+
+Usage: python benchmarks/bench_base64.py [--sizes 10,50] [--repeat 3]
+
+Each measurement runs in a fresh interpreter so ru_maxrss reflects only that encode.
+"""
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def legacy_encode(file_path: str, mime_type: str) -> str:
+    """The encode path encode_video_to_base64 used before the streaming encoder."""
+    with open(file_path, 'rb') as f:
+        base64_bytes = base64.b64encode(f.read())
+    base64_str = base64_bytes.decode('utf-8')
+    return f"data:{mime_type};base64,{base64_str}"
+
+
+def streaming_encode(file_path: str, mime_type: str) -> str:
+    from media import encode_base64_data_url
+    return encode_base64_data_url(file_path, mime_type)
+
+
+METHODS = {'legacy': legacy_encode, 'streaming': streaming_encode}
+
+
+def run_worker(method: str, file_path: str):
+    encode = METHODS[method]
+    if method == 'streaming':
+        import media  # noqa: F401  import cost stays out of the measurement
+    before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    payload = encode(file_path, 'video/mp4')
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        'seconds': elapsed,
+        'peak_rss_delta_mb': (peak_kb - before_kb) / 1024,
+        'payload_len': len(payload),
+    }))
+
+
+def measure(method: str, file_path: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', method, file_path],
+        capture_output=True, check=True, text=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,50', help='comma-separated file sizes in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--worker', nargs=2, metavar=('METHOD', 'FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(*args.worker)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in [int(s) for s in args.sizes.split(',')]:
+            file_path = os.path.join(tmp, f"{size_mb}mb.mp4")
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(size_mb * 1024 * 1024))
+            for method in METHODS:
+                runs = [measure(method, file_path) for _ in range(args.repeat)]
+                result = {
+                    'method': method,
+                    'size_mb': size_mb,
+                    'best_seconds': round(min(r['seconds'] for r in runs), 4),
+                    'peak_rss_delta_mb': round(max(r['peak_rss_delta_mb'] for r in runs), 1),
+                }
+                result['peak_rss_ratio'] = round(result['peak_rss_delta_mb'] / size_mb, 2)
+                results.append(result)
+                print(f"{method:>10} {size_mb:>4}MB  {result['best_seconds']:.3f}s  "
+                      f"peak +{result['peak_rss_delta_mb']:.1f}MB ({result['peak_rss_ratio']}x)")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
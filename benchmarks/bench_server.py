@@ -0,0 +1,373 @@
+"""Drive the Flask app against the fake WPP_Whatsapp client and report latency and throughput.
+
+Usage:
+    python benchmarks/bench_server.py --requests 300 --concurrency 16 --mix text=6,image=3,video=1 \
+        --output results.json [--compare baseline.json]
+    python benchmarks/bench_server.py --scenario batch --kind video --requests 50
+    python benchmarks/bench_server.py --scenario upload --kind image --requests 20 --batch-size 5
+
+Scenarios:
+    mixed   single sends in the --mix proportions (the default)
+    batch   the same --requests recipients sent one by one, then through /send_batch in
+            batches of --batch-size; reports recipients per second for both and the speedup
+    upload  --requests multipart /upload calls, each sending to --batch-size recipients
+
+Runs entirely locally: a temporary working directory holds synthetic media, the queue and
+failure databases, and the media cache. Sentry is disabled for the run. Images are real
+photos-like JPEGs made with Pillow, so the image pipeline does its full work; videos are
+FFmpeg test patterns when ffmpeg is on PATH, and random bytes (sent as-is) otherwise.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_wpp  # noqa: E402
+from PIL import Image  # noqa: E402
+
+ENDPOINTS = {'text': '/send_message', 'image': '/send_image_file', 'video': '/send_video_file'}
+
+
+def parse_mapping(value: str, cast=float) -> dict:
+    pairs = (item.split('=', 1) for item in value.split(',') if item)
+    return {key.strip(): cast(val) for key, val in pairs}
+
+
+def parse_sizes(value: str) -> list:
+    return [int(v) for v in value.split(',') if v]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def make_image(path: str, long_side: int):
+    """A 4:3 camera-sized JPEG: smooth gradients plus sensor-like noise, so it compresses like a photo."""
+    size = (long_side, long_side * 3 // 4)
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 24)
+    image = Image.merge('RGB', (gradient, noise, Image.radial_gradient('L').resize(size)))
+    image.save(path, format='JPEG', quality=95)
+
+
+def make_video(path: str, size_mb: int, seconds: int = 20) -> bool:
+    """An H.264/AAC test pattern of roughly size_mb; False if ffmpeg is not available."""
+    if not shutil.which('ffmpeg'):
+        return False
+    video_bps = max(100_000, int(size_mb * 8 * 1024 * 1024 / seconds) - 128_000)
+    subprocess.run([
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=1280x720:rate=30',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', str(video_bps), '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-shortest', '-movflags', '+faststart', path
+    ], check=True)
+    return True
+
+
+def make_media(workdir: str, image_sides: list, video_sizes_mb: list) -> dict:
+    media = {'image': [], 'video': [], 'real_video': True}
+    os.makedirs(os.path.join(workdir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'videos'), exist_ok=True)
+    for side in image_sides:
+        name = f"synthetic_{side}px.jpg"
+        make_image(os.path.join(workdir, 'images', name), side)
+        media['image'].append(name)
+    for size in video_sizes_mb:
+        name = f"synthetic_{size}mb.mp4"
+        path = os.path.join(workdir, 'videos', name)
+        if not make_video(path, size):
+            media['real_video'] = False
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size * 1024 * 1024))
+        media['video'].append(name)
+    return media
+
+
+def start_server(workdir: str):
+    os.chdir(workdir)
+    os.environ.update({
+        'SENTRY_DSN': '',
+        'PRETRANSCODE': '0',
+        'SEND_QUEUE_DB': os.path.join(workdir, 'send_queue.db'),
+        'FAILURE_DB': os.path.join(workdir, 'failures.db'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'cache'),
+    })
+    import server
+    from werkzeug.serving import make_server
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return server, httpd, f"http://127.0.0.1:{httpd.server_port}"
+
+
+def build_body(kind: str, media: dict, rng: random.Random, queued: bool) -> dict:
+    body = {'phone_number': f"+9745{rng.randrange(10 ** 7):07d}"}
+    if kind == 'text':
+        body['message'] = 'Benchmark message ' + 'x' * rng.randrange(10, 200)
+    else:
+        body['file_name'] = rng.choice(media[kind])
+        body['caption'] = 'Benchmark caption'
+    if queued:
+        body['queued'] = True
+    return body
+
+
+def recipients(rng: random.Random, count: int) -> list:
+    return [f"+9745{rng.randrange(10 ** 7):07d}" for _ in range(count)]
+
+
+def multipart(fields: dict, file_name: str, content: bytes) -> tuple:
+    boundary = f"bench{random.getrandbits(64):016x}"
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        for key, value in fields.items()
+    ]
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + content + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def send(base_url: str, kind: str, body: dict, timeout: float, path: str = None, sample_kind: str = None,
+         count: int = 1, upload: tuple = None) -> dict:
+    """POST one request; upload is (file_name, bytes) for a multipart /upload with body as its fields."""
+    if upload is not None:
+        data, content_type = multipart(body, *upload)
+    else:
+        data, content_type = json.dumps(body).encode('utf-8'), 'application/json'
+    req = urllib.request.Request(base_url + (path or ENDPOINTS[kind]), data=data,
+                                 headers={'Content-Type': content_type})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            status = response.status
+            payload = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        status = e.code
+        payload = json.loads(e.read() or b'{}')
+    except Exception as e:
+        status = 0
+        payload = {'success': False, 'message': str(e)}
+    return {
+        'kind': sample_kind or kind,
+        'status': status,
+        'success': bool(payload.get('success')),
+        'recipients': count,
+        # Batch replies count per-recipient outcomes; single sends are all or nothing
+        'delivered': payload.get('sent', count if payload.get('success') else 0),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def block(items: list) -> dict:
+    latencies = [s['seconds'] for s in items]
+    return {
+        'count': len(items),
+        'success': sum(1 for s in items if s['success']),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def throughput(items: list, elapsed: float) -> dict:
+    return {
+        'recipients': sum(s['recipients'] for s in items),
+        'delivered': sum(s['delivered'] for s in items),
+        'recipients_per_second': round(sum(s['recipients'] for s in items) / elapsed, 2) if elapsed else 0.0,
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+def summarise(samples: list, elapsed: float) -> dict:
+    summary = {'overall': block(samples)}
+    for kind in sorted({s['kind'] for s in samples}):
+        summary[kind] = block([s for s in samples if s['kind'] == kind])
+    summary['overall']['sends_per_second'] = round(len(samples) / elapsed, 2) if elapsed else 0.0
+    summary['overall']['elapsed_seconds'] = round(elapsed, 3)
+    return summary
+
+
+def run(jobs: list, concurrency: int) -> tuple:
+    """Run send jobs concurrently; returns (samples, elapsed seconds)."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(lambda job: job(), jobs))
+    return samples, time.perf_counter() - start
+
+
+def mixed_scenario(args, base_url: str, media: dict, rng: random.Random) -> dict:
+    mix = parse_mapping(args.mix)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    bodies = [(kind, build_body(kind, media, rng, args.queued)) for kind in kinds]
+    samples, elapsed = run([lambda kb=kb: send(base_url, kb[0], kb[1], args.timeout) for kb in bodies],
+                           args.concurrency)
+    return summarise(samples, elapsed)
+
+
+def batch_scenario(args, base_url: str, media: dict, rng: random.Random) -> dict:
+    """The same recipients one by one, then through /send_batch, with deduplication off for both."""
+    kind = args.kind
+    file_name = media[kind][0] if kind != 'text' else None
+    phones = recipients(rng, args.requests)
+
+    def body(extra: dict) -> dict:
+        content = {'message': 'Benchmark message'} if kind == 'text' else {'file_name': file_name}
+        return {**content, 'caption': 'Benchmark caption', 'dedupe': False, **extra}
+
+    single_jobs = [lambda phone=phone: send(base_url, kind, body({'phone_number': phone}), args.timeout,
+                                            sample_kind='one_by_one') for phone in phones]
+    single, single_elapsed = run(single_jobs, args.concurrency)
+    groups = [phones[i:i + args.batch_size] for i in range(0, len(phones), args.batch_size)]
+    batch_jobs = [lambda group=group: send(base_url, kind, body({'type': kind, 'recipients': group}), args.timeout,
+                                           path='/send_batch', sample_kind='batch', count=len(group))
+                  for group in groups]
+    batched, batch_elapsed = run(batch_jobs, args.concurrency)
+    results = {
+        'one_by_one': {**block(single), **throughput(single, single_elapsed)},
+        'batch': {**block(batched), **throughput(batched, batch_elapsed)},
+    }
+    one_rate = results['one_by_one']['recipients_per_second']
+    results['batch']['speedup'] = round(results['batch']['recipients_per_second'] / one_rate, 2) if one_rate else None
+    return results
+
+
+def upload_scenario(args, base_url: str, media: dict, rng: random.Random, workdir: str) -> dict:
+    """Multipart uploads of the synthetic media, each sent on to batch_size recipients."""
+    directory = 'videos' if args.kind == 'video' else 'images'
+    files = []
+    for name in media[args.kind]:
+        with open(os.path.join(workdir, directory, name), 'rb') as f:
+            files.append((name, f.read()))
+    jobs = []
+    for _ in range(args.requests):
+        name, content = rng.choice(files)
+        fields = {'recipients': ','.join(recipients(rng, args.batch_size)), 'caption': 'Benchmark caption',
+                  'dedupe': 'false'}
+        jobs.append(lambda fields=fields, name=name, content=content: send(
+            base_url, args.kind, fields, args.timeout, path='/upload', sample_kind='upload',
+            count=args.batch_size, upload=(name, content)))
+    samples, elapsed = run(jobs, args.concurrency)
+    return {'upload': {**block(samples), **throughput(samples, elapsed),
+                       'upload_mb_per_second': round(sum(len(c) for _, c in files) / len(files) * len(samples)
+                                                     / 1024 / 1024 / elapsed, 2) if elapsed else 0.0}}
+
+
+def compare(current: dict, baseline: dict):
+    print(f"\n{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for section, values in current['results'].items():
+        base = baseline.get('results', {}).get(section, {})
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'sends_per_second', 'recipients_per_second'):
+            if key in values and key in base and base[key]:
+                change = (values[key] - base[key]) / base[key] * 100
+                print(f"{section + '.' + key:<28}{base[key]:>12}{values[key]:>12}{change:>9.1f}%")
+    for key in ('peak_rss_mb',):
+        if key in baseline:
+            print(f"{key:<28}{baseline[key]:>12}{current[key]:>12}")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=('mixed', 'batch', 'upload'), default='mixed')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests (mixed, upload) or recipients (batch)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', default='text=6,image=3,video=1', help='relative weights per kind')
+    parser.add_argument('--kind', choices=('text', 'image', 'video'), default='video',
+                        help='what the batch and upload scenarios send')
+    parser.add_argument('--batch-size', type=int, default=25, help='recipients per batch or upload')
+    parser.add_argument('--image-sides', default='1200,4000', help='long edge in pixels of each synthetic image')
+    parser.add_argument('--video-sizes-mb', default='2,10')
+    parser.add_argument('--queued', action='store_true', help='send with "queued": true (measures enqueue latency)')
+    parser.add_argument('--keep-rate-limits', action='store_true',
+                        help='keep the scheduler token buckets (off by default to measure raw capacity)')
+    parser.add_argument('--text-ms', type=float, default=fake_wpp.FakeConfig.text_seconds * 1000)
+    parser.add_argument('--image-ms', type=float, default=fake_wpp.FakeConfig.image_seconds * 1000)
+    parser.add_argument('--video-ms', type=float, default=fake_wpp.FakeConfig.video_seconds * 1000)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--ack', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write JSON results here')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    args = parser.parse_args()
+
+    fake_wpp.FakeConfig.text_seconds = args.text_ms / 1000
+    fake_wpp.FakeConfig.image_seconds = args.image_ms / 1000
+    fake_wpp.FakeConfig.video_seconds = args.video_ms / 1000
+    fake_wpp.FakeConfig.failure_rate = args.failure_rate
+    fake_wpp.FakeConfig.error_rate = args.error_rate
+    fake_wpp.FakeConfig.ack = args.ack
+    fake_wpp._random.seed(args.seed)
+    fake_wpp.install()
+    if not args.keep_rate_limits:
+        os.environ.setdefault('SEND_RATE_PER_SESSION', '0')
+        os.environ.setdefault('SEND_RATE_PER_RECIPIENT', '0')
+
+    rng = random.Random(args.seed)
+    if args.scenario == 'upload' and args.kind == 'text':
+        parser.error('the upload scenario sends image or video')
+
+    with tempfile.TemporaryDirectory(prefix='whatsapp-bench-') as workdir:
+        media = make_media(workdir, parse_sizes(args.image_sides), parse_sizes(args.video_sizes_mb))
+        server, httpd, base_url = start_server(workdir)
+        if args.scenario == 'batch':
+            results = batch_scenario(args, base_url, media, rng)
+        elif args.scenario == 'upload':
+            results = upload_scenario(args, base_url, media, rng, workdir)
+        else:
+            results = mixed_scenario(args, base_url, media, rng)
+        pipeline = server.whatsapp_sender.image_pipeline
+        image_pipeline = pipeline.stats() if pipeline else None
+        httpd.shutdown()
+
+    result = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'real_video': media['real_video'],
+        'results': results,
+        'image_pipeline': image_pipeline,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'client_calls': dict(fake_wpp.stats.calls),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Local stand-in for the WPP_Whatsapp package, for benchmarks that must not touch a real account.
+
+Call install() before importing server so `from WPP_Whatsapp import Create` resolves here.
+Latency, failures and ack values are set on FakeConfig.
+"""
+import os
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+
+
+class FakeConfig:
+    start_seconds = 0.5
+    text_seconds = 0.05
+    image_seconds = 0.15
+    video_seconds = 0.3
+    video_seconds_per_mb = 0.02  # upload time grows with payload size
+    jitter = 0.2  # +/- fraction applied to every latency
+    failure_rate = 0.0  # send returns a non-delivered ack
+    error_rate = 0.0  # send raises
+    ack = 1
+    delivered_seconds = 1.0  # sent messages move to ack 2 after this long (None: never)
+    ack_events = True  # fire onAck callbacks; False mimics clients where only getMessageById sees acks
+    seed = None
+
+
+class FakeStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {'sendText': 0, 'sendFile': 0, 'sendImage': 0}
+        self.bytes = 0
+
+    def record(self, method: str, size: int = 0):
+        with self.lock:
+            self.calls[method] += 1
+            self.bytes += size
+
+
+stats = FakeStats()
+_random = random.Random(FakeConfig.seed)
+
+
+def _sleep(seconds: float):
+    spread = seconds * FakeConfig.jitter
+    time.sleep(max(0.0, seconds + _random.uniform(-spread, spread)))
+
+
+class FakeClient:
+    def __init__(self):
+        self._acks = {}
+        self._ack_callbacks = []
+
+    def _outcome(self, chat_id: str):
+        roll = _random.random()
+        if roll < FakeConfig.error_rate:
+            raise Exception("Fake client error")
+        if roll < FakeConfig.error_rate + FakeConfig.failure_rate:
+            return {'ack': -1, 'id': None}
+        message_id = f"true_{chat_id}_{uuid.uuid4().hex[:16].upper()}"
+        self._acks[message_id] = FakeConfig.ack
+        if FakeConfig.delivered_seconds is not None:
+            timer = threading.Timer(FakeConfig.delivered_seconds, self._set_ack, (message_id, 2))
+            timer.daemon = True
+            timer.start()
+        return {'ack': FakeConfig.ack, 'id': message_id}
+
+    def _set_ack(self, message_id: str, ack: int):
+        self._acks[message_id] = ack
+        if FakeConfig.ack_events:
+            for callback in list(self._ack_callbacks):
+                callback({'id': message_id, 'ack': ack})
+
+    def onAck(self, callback):
+        self._ack_callbacks.append(callback)
+        return lambda: self._ack_callbacks.remove(callback)
+
+    def getMessageById(self, message_id: str):
+        if message_id not in self._acks:
+            return None
+        return {'id': message_id, 'ack': self._acks[message_id]}
+
+    def sendText(self, to: str, content: str):
+        stats.record('sendText', len(content))
+        _sleep(FakeConfig.text_seconds)
+        return self._outcome(to)
+
+    def sendFile(self, to: str, path_or_base64: str, filename: str = None, caption: str = None):
+        size = len(path_or_base64)
+        stats.record('sendFile', size)
+        _sleep(FakeConfig.video_seconds + FakeConfig.video_seconds_per_mb * size / (1024 * 1024))
+        return self._outcome(to)
+
+    def sendImage(self, to: str, file_path: str, filename: str = None, caption: str = None):
+        stats.record('sendImage', os.path.getsize(file_path) if os.path.exists(file_path) else 0)
+        _sleep(FakeConfig.image_seconds)
+        return self._outcome(to)
+
+    def close(self):
+        pass
+
+
+class Create:
+    def __init__(self, session: str = None, **kwargs):
+        self.session = session
+        self.state = 'DISCONNECTED'
+
+    def start(self):
+        _sleep(FakeConfig.start_seconds)
+        self.state = 'CONNECTED'
+        return FakeClient()
+
+
+def install():
+    module = types.ModuleType('WPP_Whatsapp')
+    module.Create = Create
+    module.__fake__ = True
+    sys.modules['WPP_Whatsapp'] = module
+    return module
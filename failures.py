@@ -0,0 +1,220 @@
+import csv
+import io
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+# Error classes that will fail the same way however often they are retried
+PERMANENT_ERRORS = ('file_not_found', 'encode_failed')
+
+
+def normalize_phone(phone_number: str) -> str:
+    """Digits only, without an international 00 prefix, so +974..., 974... and 00974... match."""
+    digits = ''.join(ch for ch in str(phone_number) if ch.isdigit())
+    return digits[2:] if digits.startswith('00') else digits
+
+
+def classify_error(message: str) -> str:
+    text = (message or '').lower()
+    if 'file not found' in text:
+        return 'file_not_found'
+    if 'failed to encode' in text:
+        return 'encode_failed'
+    if 'not initialized' in text or 'no healthy whatsapp session' in text:
+        return 'not_connected'
+    if 'timeout' in text:
+        return 'timeout'
+    return 'send_failed'
+
+
+class FailureStore:
+    """SQLite store of failed sends, one row per recipient and file, with automatic replay.
+
+    Phone numbers are stored normalised (see normalize_phone). A later successful send of the same
+    file to the same recipient resolves the row, however it was sent.
+    """
+
+    def __init__(self, db_path: str = "failures.db", base_delay: float = 30.0, max_delay: float = 3600.0,
+                 max_attempts: int = 8):
+        self.db_path = db_path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Several session worker processes may write here; wait for the lock rather than fail
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS failures (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    phone_number TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    caption TEXT,
+                    error_class TEXT NOT NULL,
+                    message TEXT,
+                    status TEXT NOT NULL,
+                    occurrences INTEGER NOT NULL DEFAULT 1,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    UNIQUE (phone_number, file_path)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_failures_phone ON failures (phone_number)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_failures_due ON failures (status, next_attempt_at)")
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+        return delay * random.uniform(0.5, 1.5)
+
+    def record(self, phone_number: str, file_path: str, kind: str, message: str,
+               caption: Optional[str] = None) -> Dict[str, any]:
+        """Insert a failure, or bump the existing row for the same recipient and file.
+
+        The latest error decides the class; a permanent error stops retries, and a retryable one
+        reopens a row that was resolved or permanent.
+        """
+        phone_number, file_path = normalize_phone(phone_number), os.path.normpath(file_path)
+        error_class = classify_error(message)
+        status = 'permanent' if error_class in PERMANENT_ERRORS else 'pending'
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO failures (phone_number, file_path, kind, caption, error_class, message, status,
+                                      next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (phone_number, file_path) DO UPDATE SET
+                    occurrences = occurrences + 1,
+                    error_class = excluded.error_class,
+                    message = excluded.message,
+                    caption = COALESCE(excluded.caption, caption),
+                    next_attempt_at = CASE WHEN status IN ('resolved', 'permanent') OR excluded.status = 'permanent'
+                        THEN excluded.next_attempt_at ELSE next_attempt_at END,
+                    status = CASE WHEN status IN ('resolved', 'permanent') OR excluded.status = 'permanent'
+                        THEN excluded.status ELSE status END,
+                    updated_at = excluded.updated_at
+            """, (phone_number, file_path, kind, caption, error_class, message, status,
+                  now + self._backoff(0), now, now))
+            row = self._conn.execute(
+                "SELECT * FROM failures WHERE phone_number = ? AND file_path = ?", (phone_number, file_path)
+            ).fetchone()
+        return dict(row)
+
+    def resolve(self, phone_number: str, file_path: str) -> int:
+        """Mark open failures for this recipient and file resolved after a successful send."""
+        with self._lock, self._conn:
+            return self._conn.execute("""
+                UPDATE failures SET status = 'resolved', next_attempt_at = NULL, updated_at = ?
+                WHERE phone_number = ? AND file_path = ? AND status != 'resolved'
+            """, (time.time(), normalize_phone(phone_number), os.path.normpath(file_path))).rowcount
+
+    def query(self, phone_number: Optional[str] = None, status: Optional[str] = None,
+              limit: int = 100) -> List[Dict[str, any]]:
+        clauses, params = [], []
+        if phone_number:
+            clauses.append("phone_number = ?")
+            params.append(normalize_phone(phone_number))
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM failures {where} ORDER BY updated_at DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM failures GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def import_csv(self, csv_path: str) -> int:
+        """Load rows from a legacy error_files.csv; returns how many rows were imported."""
+        with open(csv_path, newline='') as file:
+            return self.import_rows(file, csv_path)
+
+    def import_text(self, text: str, source: str = 'request body') -> int:
+        return self.import_rows(io.StringIO(text, newline=''), source)
+
+    def import_rows(self, lines: Iterable[str], source: str) -> int:
+        count = 0
+        for row in csv.DictReader(lines):
+            phone_number, file_path = row.get('Phone Number'), row.get('File Path')
+            if not phone_number or not file_path:
+                continue
+            kind = 'image' if file_path.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')) else 'video'
+            message = 'Imported from CSV' if os.path.exists(file_path) else f'File not found: {file_path}'
+            self.record(phone_number, file_path, kind, message)
+            count += 1
+        sentry_sdk.logger.info(f"Imported {count} failed sends from {source}")
+        return count
+
+    def start_replay(self, replay: Callable[[Dict[str, any]], Dict[str, any]], is_ready: Callable[[], bool],
+                     interval: float = 10.0, batch_size: int = 20):
+        """Retry due failures in the background whenever is_ready() says the client is usable."""
+        def loop():
+            while not self._stop_event.wait(interval):
+                try:
+                    if is_ready():
+                        self.replay_due(replay, batch_size)
+                except Exception as e:
+                    capture_exception(e)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=loop, name="failure-replay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def replay_due(self, replay: Callable[[Dict[str, any]], Dict[str, any]], batch_size: int = 20) -> int:
+        now = time.time()
+        with self._lock, self._conn:
+            rows = self._conn.execute("""
+                SELECT * FROM failures WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            """, (now, batch_size)).fetchall()
+            # Claim the rows so a slow replay is not picked up again by the next pass
+            self._conn.executemany(
+                "UPDATE failures SET status = 'retrying' WHERE id = ?", [(row['id'],) for row in rows]
+            )
+        for row in rows:
+            result = replay(dict(row)) or {'success': False, 'message': 'Timeout or error in sending'}
+            attempts = row['attempts'] + 1
+            if result.get('success'):
+                status, next_attempt_at = 'resolved', None
+            elif attempts >= self.max_attempts:
+                status, next_attempt_at = 'exhausted', None
+            elif classify_error(result.get('message', '')) in PERMANENT_ERRORS:
+                status, next_attempt_at = 'permanent', None
+            else:
+                status, next_attempt_at = 'pending', time.time() + self._backoff(attempts)
+            with self._lock, self._conn:
+                # Skipped if another send resolved (or re-recorded) the row while this replay ran
+                self._conn.execute("""
+                    UPDATE failures SET status = ?, attempts = ?, next_attempt_at = ?, message = ?, updated_at = ?
+                    WHERE id = ? AND status = 'retrying'
+                """, (status, attempts, next_attempt_at, result.get('message'), time.time(), row['id']))
+        if rows:
+            sentry_sdk.logger.info(f"Replayed {len(rows)} failed sends")
+        return len(rows)
+
+    def requeue_interrupted(self):
+        """Rows left 'retrying' by a crash go back to pending."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE failures SET status = 'pending' WHERE status = 'retrying'")
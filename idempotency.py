@@ -0,0 +1,157 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+import sentry_sdk
+import sentry_sdk.logger
+
+Reply = Tuple[Dict[str, any], int]
+
+MISMATCH = {'success': False, 'message': 'Idempotency-Key was already used for a different request'}
+
+
+class IdempotencyCache:
+    """Replies to sends keyed by idempotency key, kept in SQLite until their TTL runs out.
+
+    A duplicate of a send that is still running waits for the original's reply instead of sending again.
+    Each key carries a fingerprint of its request; reusing a key for a different request gets a 422.
+    """
+
+    def __init__(self, db_path: str = "idempotency.db", wait_timeout: float = 120.0, prune_every: int = 500):
+        self.db_path = db_path
+        self.wait_timeout = wait_timeout
+        self.prune_every = prune_every
+        self.counters = {'hits': 0, 'attached': 0, 'misses': 0, 'stored': 0, 'mismatched': 0}
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Tuple[Future, str]] = {}
+        self._writes = 0
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS replies (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_replies_expiry ON replies (expires_at)")
+        self.prune()
+
+    def _stored(self, key: str):
+        # Called with self._lock held
+        row = self._conn.execute(
+            "SELECT fingerprint, body, status FROM replies WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return (row['fingerprint'], json.loads(row['body']), row['status']) if row else None
+
+    def run(self, key: str, ttl: float, fingerprint: str, send: Callable[[], Reply],
+            should_store: Callable[[Dict[str, any], int], bool],
+            pending: Optional[Callable[[Dict[str, any]], Optional[Future]]] = None) -> Tuple[Dict[str, any], int, bool]:
+        """Return (body, status, replayed). Only replies passing should_store are kept, so failures can be retried.
+
+        pending(body) returns a future of the final reply when send() came back before the send itself
+        finished. The key then stays in flight until that future resolves: duplicates get the provisional
+        reply rather than sending again, and the final reply is the one stored.
+        """
+        with self._lock:
+            stored = self._stored(key)
+            if stored is not None:
+                if stored[0] != fingerprint:
+                    self.counters['mismatched'] += 1
+                    return MISMATCH, 422, False
+                self.counters['hits'] += 1
+                return stored[1], stored[2], True
+            entry = self._in_flight.get(key)
+            if entry is None:
+                original = None
+                future = Future()
+                self._in_flight[key] = (future, fingerprint)
+                self.counters['misses'] += 1
+            elif entry[1] != fingerprint:
+                self.counters['mismatched'] += 1
+                return MISMATCH, 422, False
+            else:
+                original = entry[0]
+                self.counters['attached'] += 1
+        if original is not None:
+            sentry_sdk.logger.info(f"Duplicate request {key} attached to the send in flight")
+            try:
+                body, status = original.result(timeout=self.wait_timeout)
+            except Exception:
+                return {'success': False, 'message': 'A request with this idempotency key is still in progress'}, 409, True
+            return body, status, True
+        try:
+            body, status = send()
+        except Exception as e:
+            future.set_exception(e)
+            self._release(key)
+            raise
+        final = pending(body) if pending else None
+        if final is None:
+            if should_store(body, status):
+                self._store(key, ttl, fingerprint, body, status)
+            future.set_result((body, status))
+            self._release(key)
+        else:
+            future.set_result((body, status))
+            final.add_done_callback(lambda f: self._settle(key, ttl, fingerprint, f, should_store))
+        return body, status, False
+
+    def replay(self, key: str, fingerprint: str) -> Optional[Reply]:
+        """The stored reply for key, if any and made for the same request; never waits or sends."""
+        with self._lock:
+            stored = self._stored(key)
+            if stored is None or stored[0] != fingerprint:
+                return None
+            self.counters['hits'] += 1
+            return stored[1], stored[2]
+
+    def remember(self, key: str, ttl: float, fingerprint: str, body: Dict[str, any], status: int):
+        """Store a reply for a send made outside run(), such as one recipient of a batch."""
+        self._store(key, ttl, fingerprint, body, status)
+
+    def _settle(self, key: str, ttl: float, fingerprint: str, final: Future,
+                should_store: Callable[[Dict[str, any], int], bool]):
+        try:
+            body, status = final.result()
+            if should_store(body, status):
+                self._store(key, ttl, fingerprint, body, status)
+        except Exception as e:
+            sentry_sdk.logger.error(f"Could not settle idempotency key {key}: {str(e)}")
+        finally:
+            self._release(key)
+
+    def _release(self, key: str):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def _store(self, key: str, ttl: float, fingerprint: str, body: Dict[str, any], status: int):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO replies (key, fingerprint, body, status, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, fingerprint, json.dumps(body), status, now, now + ttl)
+            )
+            self.counters['stored'] += 1
+            self._writes += 1
+            due = self._writes % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM replies WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
+            return {**self.counters, 'entries': entries, 'in_flight': len(self._in_flight)}
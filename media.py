@@ -0,0 +1,589 @@
+import binascii
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import sentry_sdk
+import sentry_sdk.logger
+from PIL import Image, ImageOps
+from sentry_sdk import capture_exception
+
+import metrics
+from metrics import timed
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 hex digest of a file, read in fixed-size chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+WHATSAPP_MAX_VIDEO_BYTES = 50 * 1024 * 1024
+# Below this a size-targeted encode is not worth sending; such videos are reported as too large
+MIN_TARGET_VIDEO_BPS = 100_000
+
+
+class SpoolFile:
+    """Temporary file on disk that hashes everything written to it, for uploads of any size.
+
+    Handed to Werkzeug as the multipart file stream, or filled from a raw request body by
+    spool_stream, so an upload is written once and its digest is known when it lands.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-', suffix='.part', delete=False)
+        self.path = self.file.name
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def spool_stream(stream, directory: str, chunk_size: int = 1024 * 1024) -> SpoolFile:
+    """Copy a readable stream into a SpoolFile in fixed-size chunks."""
+    spool = SpoolFile(directory)
+    try:
+        with timed('upload_spool'):
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                spool.write(chunk)
+        spool.flush()
+    except BaseException:
+        spool.discard()
+        raise
+    return spool
+
+
+def sweep_spools(directory: str) -> int:
+    """Delete spool files left behind by a previous run, e.g. by a crash mid-upload."""
+    if not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        if name.startswith('upload-') and name.endswith('.part'):
+            try:
+                os.remove(os.path.join(directory, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def probe_media(file_path: str) -> Optional[Dict[str, any]]:
+    """Read stream codecs and duration with ffprobe; None if ffprobe is missing or fails."""
+    try:
+        with timed('ffprobe'):
+            out = subprocess.run([
+                'ffprobe', '-v', 'error', '-print_format', 'json',
+                '-show_entries', 'stream=codec_type,codec_name:format=duration',
+                file_path
+            ], capture_output=True, check=True, text=True)
+        info = json.loads(out.stdout)
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+        capture_exception(e)
+        return None
+    streams = info.get('streams', [])
+    video = next((s['codec_name'] for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s['codec_name'] for s in streams if s.get('codec_type') == 'audio'), None)
+    duration = info.get('format', {}).get('duration')
+    return {
+        'video_codec': video,
+        'audio_codec': audio,
+        'duration': float(duration) if duration else None,
+    }
+
+
+def target_bitrate(max_bytes: int, duration: float, audio_bitrate: int = 128_000,
+                   headroom: float = 0.9) -> Optional[int]:
+    """Video bitrate that fits `duration` seconds into max_bytes; None if it would drop below MIN_TARGET_VIDEO_BPS."""
+    video_bps = int(max_bytes * 8 * headroom / duration) - audio_bitrate
+    return video_bps if video_bps >= MIN_TARGET_VIDEO_BPS else None
+
+
+def target_args(video_bps: int, audio_bitrate: int = 128_000) -> Tuple[str, ...]:
+    return (
+        '-c:v', 'libx264', '-preset', 'fast', '-b:v', str(video_bps),
+        '-maxrate', str(video_bps), '-bufsize', str(video_bps * 2),
+        '-c:a', 'aac', '-b:a', str(audio_bitrate), '-movflags', '+faststart'
+    )
+
+
+def plan_conversion(file_path: str, probe: Dict[str, any], transcode_args: Tuple[str, ...],
+                    max_bytes: int = WHATSAPP_MAX_VIDEO_BYTES,
+                    audio_bitrate: int = 128_000) -> Tuple[str, Tuple[str, ...]]:
+    """Pick the cheapest way to make a video WhatsApp-ready.
+
+    Returns (action, ffmpeg_args) where action is 'none', 'remux', 'transcode', 'target' or
+    'too_large' (no bitrate fits it under max_bytes). A 'target' output must still be size-checked.
+    """
+    size = os.path.getsize(file_path)
+    if not probe['video_codec']:
+        return 'transcode', (*transcode_args, '-movflags', '+faststart')
+    duration = probe['duration']
+    if size > max_bytes:
+        if not duration:
+            # Nothing to aim at yet; the size check retargets from the transcoded output's duration
+            return 'target', (*transcode_args, '-movflags', '+faststart')
+        # 10% headroom covers container overhead and single-pass rate control overshoot
+        video_bps = target_bitrate(max_bytes, duration, audio_bitrate)
+        if video_bps is None:
+            return 'too_large', ()
+        return 'target', target_args(video_bps, audio_bitrate)
+    video_ok = probe['video_codec'] == 'h264'
+    audio_ok = probe['audio_codec'] in (None, 'aac')
+    if video_ok and audio_ok and file_path.lower().endswith('.mp4'):
+        return 'none', ()
+    if video_ok:
+        audio_args = ('-c:a', 'copy') if audio_ok else ('-c:a', 'aac', '-b:a', str(audio_bitrate))
+        return 'remux', ('-c:v', 'copy', *audio_args, '-movflags', '+faststart')
+    return 'transcode', (*transcode_args, '-movflags', '+faststart')
+
+
+def encode_base64_data_url(file_path: str, mime_type: str, use_data_url: bool = True,
+                           chunk_size: int = 3 * 256 * 1024) -> str:
+    """Base64-encode a file into one preallocated buffer using fixed-size reads.
+
+    The buffer (~1.33x the file size) is the only full-size allocation until the
+    final ASCII decode the client needs; see benchmarks/bench_base64.py.
+    """
+    chunk_size -= chunk_size % 3  # keep chunks on base64 group boundaries so no padding mid-stream
+    prefix = f"data:{mime_type};base64,".encode('ascii') if use_data_url else b''
+    file_size = os.path.getsize(file_path)
+    out = bytearray(len(prefix) + 4 * ((file_size + 2) // 3))
+    out[:len(prefix)] = prefix
+    pos = len(prefix)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    read_seconds = 0.0
+    start = time.perf_counter()
+    with open(file_path, 'rb') as f:
+        while True:
+            t0 = time.perf_counter()
+            n = f.readinto(buf)
+            read_seconds += time.perf_counter() - t0
+            if not n:
+                break
+            encoded = binascii.b2a_base64(view[:n], newline=False)
+            out[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+    metrics.observe_stage('file_read', read_seconds)
+    metrics.observe_stage('base64_encode', time.perf_counter() - start - read_seconds)
+    if pos != len(out):
+        raise IOError(f"File changed size while encoding: {file_path}")
+    return out.decode('ascii')
+
+
+class MediaCache:
+    """Content-addressed cache for converted videos (on disk) and encoded payloads (in memory)."""
+
+    def __init__(self, cache_dir: str = "./cache", max_disk_bytes: int = 2 * 1024 ** 3,
+                 max_memory_bytes: int = 256 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        # path -> (mtime_ns, size, digest); a changed mtime or size forces a rehash
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._payloads: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self._disk_bytes = 0
+        self._memory_bytes = 0
+        self.counters = {
+            'conversion_hits': 0, 'conversion_misses': 0,
+            'payload_hits': 0, 'payload_misses': 0,
+            'disk_evictions': 0, 'memory_evictions': 0, 'invalidations': 0,
+        }
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '.part' in name or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._disk_bytes += size
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def source_digest(self, file_path: str) -> str:
+        """Content hash of a source file, recomputed only when its mtime or size changes."""
+        stat = os.stat(file_path)
+        with self._lock:
+            cached = self._digests.get(file_path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        digest = hash_file(file_path)
+        with self._lock:
+            self._digests[file_path] = (stat.st_mtime_ns, stat.st_size, digest)
+            if cached and cached[2] != digest:
+                self._invalidate_digest(cached[2])
+        return digest
+
+    def remember_digest(self, file_path: str, digest: str):
+        """Record a digest computed elsewhere (e.g. while an upload was written) to skip rehashing."""
+        stat = os.stat(file_path)
+        with self._lock:
+            self._digests[file_path] = (stat.st_mtime_ns, stat.st_size, digest)
+
+    def _invalidate_digest(self, digest: str):
+        # Called with self._lock held
+        stale = [key for key in self._payloads if key.startswith(digest)]
+        for key in stale:
+            value = self._payloads.pop(key)
+            self._memory_bytes -= len(value[0])
+        self.counters['invalidations'] += 1
+        sentry_sdk.logger.info(f"Invalidated {len(stale)} cached payloads for changed source {digest[:12]}")
+
+    def make_key(self, file_path: str, settings: str) -> str:
+        settings_hash = hashlib.sha256(settings.encode('utf-8')).hexdigest()[:16]
+        return f"{self.source_digest(file_path)}-{settings_hash}"
+
+    def get_converted(self, file_path: str, settings: str, suffix: str,
+                      convert: Callable[[str, str], bool]) -> Optional[str]:
+        """Return the cached conversion of file_path, running convert(input, output) on a miss."""
+        name = f"{self.make_key(file_path, settings)}{suffix}"
+        cached_path = os.path.join(self.cache_dir, name)
+        with self._key_lock(name):
+            with self._lock:
+                # The file may have been written by another process sharing cache_dir
+                if os.path.exists(cached_path):
+                    if name not in self._files:
+                        size = os.path.getsize(cached_path)
+                        self._files[name] = size
+                        self._disk_bytes += size
+                    self._files.move_to_end(name)
+                    self.counters['conversion_hits'] += 1
+                    os.utime(cached_path)
+                    return cached_path
+                self.counters['conversion_misses'] += 1
+            part_path = f"{cached_path}.{os.getpid()}.part{suffix}"
+            try:
+                if not convert(file_path, part_path):
+                    return None
+                os.replace(part_path, cached_path)
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            size = os.path.getsize(cached_path)
+            with self._lock:
+                self._files[name] = size
+                self._disk_bytes += size
+                self._evict_disk(keep=name)
+            sentry_sdk.logger.info(f"Cached converted video {cached_path}")
+            return cached_path
+
+    def _evict_disk(self, keep: str):
+        # Called with self._lock held
+        while self._disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+            name, size = next(iter(self._files.items()))
+            if name == keep:
+                self._files.move_to_end(name)
+                continue
+            self._files.pop(name)
+            self._disk_bytes -= size
+            self.counters['disk_evictions'] += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError as e:
+                capture_exception(e)
+
+    def get_payload(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            value = self._payloads.get(key)
+            if value is None:
+                self.counters['payload_misses'] += 1
+                return None
+            self._payloads.move_to_end(key)
+            self.counters['payload_hits'] += 1
+            return value
+
+    def put_payload(self, key: str, payload: str, mime_type: str):
+        size = len(payload)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._payloads.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[0])
+            self._payloads[key] = (payload, mime_type)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (evicted, _) = self._payloads.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self.counters['memory_evictions'] += 1
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            return {
+                **self.counters,
+                'disk_entries': len(self._files),
+                'disk_bytes': self._disk_bytes,
+                'memory_entries': len(self._payloads),
+                'memory_bytes': self._memory_bytes,
+            }
+
+
+# WhatsApp's standard-quality sends are scaled to fit 1600px; anything larger is thrown away on upload
+WHATSAPP_IMAGE_MAX_SIDE = 1600
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+image_bytes_saved_total = metrics.registry.counter(
+    'whatsapp_image_bytes_saved_total', 'Bytes removed from images by resizing and recompression'
+)
+
+
+def is_still_image(file_path: str) -> bool:
+    """True for a single-frame image of a supported type; flattening an animation to JPEG keeps one frame."""
+    if not file_path.lower().endswith(IMAGE_EXTENSIONS):
+        return False
+    try:
+        with Image.open(file_path) as image:
+            return not getattr(image, 'is_animated', False)
+    except Exception:
+        return False
+
+
+def optimize_image(input_path: str, output_path: str, max_side: int = WHATSAPP_IMAGE_MAX_SIDE,
+                   quality: int = 82) -> Dict[str, any]:
+    """Write an EXIF-upright JPEG of input_path no larger than max_side on its long edge.
+
+    Runs in a worker process. A JPEG that needs no rotation or resize and does not shrink
+    on recompression is copied unchanged.
+    """
+    start = time.perf_counter()
+    input_bytes = os.path.getsize(input_path)
+    with Image.open(input_path) as original:
+        source_format = original.format
+        rotated = original.getexif().get(0x0112, 1) != 1
+        image = ImageOps.exif_transpose(original)
+        resized = max(image.size) > max_side
+        if resized:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # JPEG has no alpha; flatten onto white as WhatsApp does
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        # No exif= argument, so camera metadata (including the orientation tag) is dropped
+        image.save(output_path, format='JPEG', quality=quality, optimize=True, progressive=True)
+    kept_original = False
+    if source_format == 'JPEG' and not (rotated or resized) and os.path.getsize(output_path) >= input_bytes:
+        shutil.copyfile(input_path, output_path)
+        kept_original = True
+    return {
+        'input_bytes': input_bytes,
+        'output_bytes': os.path.getsize(output_path),
+        'seconds': time.perf_counter() - start,
+        'kept_original': kept_original,
+    }
+
+
+class ImagePipeline:
+    """Resize, EXIF-normalise and recompress images in a process pool, caching derivatives in MediaCache.
+
+    The pool is forked by start(), which must run before the process starts any thread; without a
+    started pool, images are optimized on the calling thread rather than forking late.
+    """
+
+    def __init__(self, cache: MediaCache, max_side: int = WHATSAPP_IMAGE_MAX_SIDE, quality: int = 82,
+                 workers: Optional[int] = None):
+        self.cache = cache
+        self.max_side = max_side
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.settings = f"image max_side={max_side} quality={quality}"
+        self._pool = None
+        self._lock = threading.Lock()
+        self.counters = {
+            'processed': 0, 'kept_original': 0, 'skipped': 0, 'failures': 0,
+            'input_bytes': 0, 'output_bytes': 0, 'seconds': 0.0,
+        }
+
+    def start(self):
+        """Fork the worker processes now, while it is still safe to fork."""
+        with self._lock:
+            if self._pool is not None:
+                return
+            # Fork like the session workers: spawn would re-import the app and start a second client
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+        # With fork, the first submit launches every worker at once, so none is forked later on demand
+        self._pool.submit(os.getpid).result()
+
+    def _run(self, input_path: str, output_path: str) -> Dict[str, any]:
+        with self._lock:
+            pool = self._pool
+        if pool is not None:
+            try:
+                return pool.submit(optimize_image, input_path, output_path, self.max_side, self.quality).result()
+            except BrokenProcessPool as e:
+                # A worker died; re-forking now could copy a lock held by one of our threads
+                capture_exception(e)
+                with self._lock:
+                    if self._pool is pool:
+                        self._pool = None
+                sentry_sdk.logger.error("Image worker pool broke; optimizing on the calling thread from now on")
+        return optimize_image(input_path, output_path, self.max_side, self.quality)
+
+    def _optimize(self, input_path: str, output_path: str) -> bool:
+        try:
+            result = self._run(input_path, output_path)
+        except Exception as e:
+            capture_exception(e)
+            with self._lock:
+                self.counters['failures'] += 1
+            return False
+        saved = result['input_bytes'] - result['output_bytes']
+        metrics.observe_stage('image_optimize', result['seconds'])
+        if saved > 0:
+            image_bytes_saved_total.inc(saved)
+        with self._lock:
+            self.counters['processed'] += 1
+            self.counters['kept_original'] += int(result['kept_original'])
+            self.counters['input_bytes'] += result['input_bytes']
+            self.counters['output_bytes'] += result['output_bytes']
+            self.counters['seconds'] += result['seconds']
+        sentry_sdk.logger.info(
+            f"Optimized {input_path}: {result['input_bytes']} -> {result['output_bytes']} bytes "
+            f"in {result['seconds'] * 1000:.0f}ms"
+        )
+        return True
+
+    def derivative(self, file_path: str) -> Optional[str]:
+        """Path of the send-ready JPEG for file_path, producing it on a cache miss.
+
+        None if it cannot be made, or if the file is sent unchanged: animations and unsupported types.
+        """
+        if not is_still_image(file_path):
+            with self._lock:
+                self.counters['skipped'] += 1
+            return None
+        return self.cache.get_converted(file_path, self.settings, '.jpg', self._optimize)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            counters = dict(self.counters)
+        processed = counters['processed']
+        return {
+            **counters,
+            'seconds': round(counters['seconds'], 3),
+            'bytes_saved': counters['input_bytes'] - counters['output_bytes'],
+            'avg_ms_per_image': round(counters['seconds'] * 1000 / processed, 1) if processed else None,
+        }
+
+
+class DirectoryWatcher:
+    """Poll a directory and hand new or changed files to a worker pool once they stop changing."""
+
+    def __init__(self, directory: str, extensions: Iterable[str], handler: Callable[[str], any],
+                 workers: Optional[int] = None, interval: float = 2.0):
+        self.directory = directory
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.handler = handler
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                           thread_name_prefix="watcher")
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        self._settling: Dict[str, Tuple[int, int]] = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        sentry_sdk.logger.info(f"Watching {self.directory} for {', '.join(self.extensions)} files")
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._poll_loop, name="watcher-poll", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, path: str):
+        """Process a file now rather than waiting for the next scan to notice it."""
+        stat = os.stat(path)
+        self._seen[path] = (stat.st_size, stat.st_mtime_ns)
+        self._settling.pop(path, None)
+        self.executor.submit(self._run, path)
+
+    def _poll_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                capture_exception(e)
+            self._stop_event.wait(self.interval)
+
+    def scan(self):
+        """Submit files whose size and mtime held steady since the previous scan."""
+        if not os.path.isdir(self.directory):
+            return
+        present = set()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.lower().endswith(self.extensions):
+                continue
+            path = entry.path
+            present.add(path)
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(path) == signature:
+                continue
+            # Files still being copied in keep changing; wait for one quiet interval
+            if self._settling.get(path) != signature:
+                self._settling[path] = signature
+                continue
+            del self._settling[path]
+            self._seen[path] = signature
+            sentry_sdk.logger.info(f"Queueing background processing of {path}")
+            self.executor.submit(self._run, path)
+        for tracked in (self._seen, self._settling):
+            for path in [p for p in list(tracked) if p not in present]:
+                del tracked[path]
+
+    def _run(self, path: str):
+        try:
+            self.handler(path)
+        except Exception as e:
+            capture_exception(e)
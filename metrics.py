@@ -0,0 +1,223 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sentry_sdk import capture_exception
+
+# Seconds; spans a text send (~50ms) through a large video transcode
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def snapshot(self) -> Dict[LabelValues, any]:
+        """Picklable copy of the values, for merging into another process's registry."""
+        return {}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, remote: Iterable[Dict[LabelValues, float]] = ()) -> List[str]:
+        values = self.snapshot()
+        for other in remote:
+            for labels, value in other.items():
+                values[labels] = values.get(labels, 0.0) + value
+        return self.header() + [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels: str) -> '_Timer':
+        return _Timer(self, labels)
+
+    def snapshot(self) -> Dict[LabelValues, List[float]]:
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    def render(self, remote: Iterable[Dict[LabelValues, List[float]]] = ()) -> List[str]:
+        values = self.snapshot()
+        for other in remote:
+            for labels, series in other.items():
+                mine = values.get(labels)
+                values[labels] = list(series) if mine is None else [a + b for a, b in zip(mine, series)]
+        lines = self.header()
+        for labels, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """Context manager for Histogram.time; a plain class is several times cheaper than @contextmanager."""
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: LabelValues):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Gauge(_Metric):
+    """Gauge read at scrape time from a callback returning {label_values: value}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], Dict[LabelValues, float]],
+                 labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.read = read
+
+    def render(self, remote: Iterable[Dict[LabelValues, float]] = ()) -> List[str]:
+        # Gauges are read live by whichever process owns the value; remote snapshots do not apply
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self.read().items()
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._remote: Callable[[], Iterable[Dict[str, Dict[LabelValues, any]]]] = list
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], Dict[LabelValues, float]],
+              labels: Iterable[str] = ()) -> Gauge:
+        with self._lock:
+            # Re-registering replaces the callback so the latest owner of the value wins
+            self._metrics[name] = Gauge(name, help_text, read, labels)
+            return self._metrics[name]
+
+    def snapshot(self) -> Dict[str, Dict[LabelValues, any]]:
+        """Counter and histogram values by metric name, as sent to the parent by session workers."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics if not isinstance(m, Gauge)}
+
+    def merge_remote(self, read: Callable[[], Iterable[Dict[str, Dict[LabelValues, any]]]]):
+        """Add the latest snapshots of other processes (session workers) into every render."""
+        self._remote = read
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        try:
+            remote = list(self._remote())
+        except Exception as e:
+            capture_exception(e)
+            remote = []
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render([r[metric.name] for r in remote if metric.name in r]))
+            except Exception as e:
+                # One broken gauge callback must not take the whole scrape down, but it must be seen
+                capture_exception(e)
+                lines.append(f"# {metric.name} failed to render: {type(e).__name__}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'whatsapp_stage_seconds', 'Time spent in each stage of a send', labels=('stage',)
+)
+sends_total = registry.counter(
+    'whatsapp_sends_total', 'Sends completed, by kind and outcome', labels=('kind', 'outcome')
+)
+bytes_sent_total = registry.counter(
+    'whatsapp_bytes_sent_total', 'Payload bytes handed to the WhatsApp client', labels=('kind',)
+)
+
+
+def timed(stage: str):
+    """Record the duration of the enclosed block under whatsapp_stage_seconds{stage=...}."""
+    return stage_seconds.time(stage)
+
+
+def observe_stage(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage)
+
+
+def overhead_ns(iterations: int = 100000) -> float:
+    """Mean cost in nanoseconds of one timed block, for checking the layer stays cheap."""
+    probe = Histogram('overhead_probe', 'probe', labels=('stage',))
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        with probe.time('probe'):
+            pass
+    return (time.perf_counter_ns() - start) / iterations
@@ -0,0 +1,317 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+import metrics
+
+queue_wait_seconds = metrics.registry.histogram(
+    'whatsapp_queue_wait_seconds', 'Time a send waited in its scheduler lane', labels=('lane',)
+)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def send_outcome(future: Future) -> Dict[str, any]:
+    """Result dict of a finished send future; cancellations and exceptions become failures."""
+    if future.cancelled():
+        return {'success': False, 'message': 'Send cancelled'}
+    error = future.exception()
+    if error is not None:
+        return {'success': False, 'message': f'Error: {str(error)}'}
+    return future.result() or {'success': False, 'message': 'Timeout or error in sending'}
+
+
+def in_progress(send_id: str) -> Dict[str, any]:
+    """Reply for a send that started but had not finished when the caller stopped waiting."""
+    return {
+        'success': False,
+        'in_progress': True,
+        'send_id': send_id,
+        'message': 'Send is still in progress; delivery is not confirmed yet'
+    }
+
+
+class UnfinishedSends:
+    """Sends that outlived their caller's wait, by send id, so their real outcome can still be collected.
+
+    Such a send may yet be delivered, so it is reported as in progress rather than failed and must
+    not be retried; whoever needs the outcome waits on get(send_id) or settle().
+    """
+
+    def __init__(self, keep: int = 1000):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._sends: "OrderedDict[str, Future]" = OrderedDict()
+
+    def add(self, source: Future, on_failure: Optional[Callable[[Dict[str, any]], any]] = None,
+            send_id: Optional[str] = None) -> str:
+        """Track a running send; on_failure gets its result if it ends up failing."""
+        send_id = send_id or uuid.uuid4().hex
+        settled = Future()
+        with self._lock:
+            self._sends[send_id] = settled
+            # Outcomes of finished sends are kept for a while for late settle() calls
+            for old_id in [i for i, f in self._sends.items() if f.done()][:max(0, len(self._sends) - self.keep)]:
+                del self._sends[old_id]
+
+        def done(future: Future):
+            result = send_outcome(future)
+            if on_failure is not None and not result.get('success'):
+                try:
+                    on_failure(result)
+                except Exception as e:
+                    capture_exception(e)
+            settled.set_result(result)
+
+        source.add_done_callback(done)
+        return send_id
+
+    def get(self, send_id: Optional[str]) -> Optional[Future]:
+        """Future of the final result dict, or None for an unknown (or long forgotten) send id."""
+        with self._lock:
+            return self._sends.get(send_id)
+
+    def settle(self, result: Optional[Dict[str, any]], timeout: Optional[float] = None) -> Optional[Dict[str, any]]:
+        """Wait for an in-progress result to become final; any other result is returned as is."""
+        if not result or not result.get('in_progress'):
+            return result
+        future = self.get(result.get('send_id'))
+        if future is None:
+            return result
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            return result
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(1 for f in self._sends.values() if not f.done())
+
+
+class ScheduledFuture(Future):
+    """Future of a scheduled send; `started` is set once the scheduler hands it to dispatch."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+
+
+class _Item:
+    __slots__ = ('lane', 'recipient', 'func', 'args', 'future', 'enqueued_at')
+
+    def __init__(self, lane: str, recipient: str, func: Callable, args: tuple):
+        self.lane = lane
+        self.recipient = recipient
+        self.func = func
+        self.args = args
+        self.future = ScheduledFuture()
+        self.enqueued_at = time.monotonic()
+
+
+class SendScheduler:
+    """Priority lanes with weighted fair dequeueing, paced by per-session and per-recipient token buckets.
+
+    `dispatch(func, args)` starts the work and returns a concurrent Future; the scheduler
+    only decides when each queued send may start.
+    """
+
+    LANES = ('text', 'image', 'video')
+
+    def __init__(self, dispatch: Callable[[Callable, tuple], Future],
+                 weights: Optional[Dict[str, int]] = None,
+                 lane_limits: Optional[Dict[str, int]] = None,
+                 session_rate: float = 2.0, session_burst: float = 10.0,
+                 recipient_rate: float = 0.5, recipient_burst: float = 3.0,
+                 scan_depth: int = 32):
+        self.dispatch = dispatch
+        self.weights = {'text': 6, 'image': 3, 'video': 1, **(weights or {})}
+        self.lane_limits = {'text': 2, 'image': 1, 'video': 1, **(lane_limits or {})}
+        self.session_bucket = TokenBucket(session_rate, session_burst)
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.scan_depth = scan_depth
+        self._recipient_buckets: Dict[str, TokenBucket] = {}
+        self._lanes: Dict[str, Deque[_Item]] = {lane: deque() for lane in self.LANES}
+        self._in_flight = {lane: 0 for lane in self.LANES}
+        self._credit = {lane: 0 for lane in self.LANES}
+        self._lane_stats = {lane: {'dispatched': 0, 'wait_total': 0.0, 'wait_max': 0.0} for lane in self.LANES}
+        self.throttled = {'session': 0, 'recipient': 0}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._dispatch_loop, name="send-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def submit(self, lane: str, recipient: str, func: Callable, *args) -> ScheduledFuture:
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown lane: {lane}")
+        self.start()
+        item = _Item(lane, recipient, func, args)
+        with self._cond:
+            self._lanes[lane].append(item)
+            self._cond.notify()
+        return item.future
+
+    def _recipient_bucket(self, recipient: str) -> TokenBucket:
+        bucket = self._recipient_buckets.get(recipient)
+        if bucket is None:
+            bucket = self._recipient_buckets[recipient] = TokenBucket(self.recipient_rate, self.recipient_burst)
+        return bucket
+
+    def _pick(self, now: float) -> Tuple[Optional[_Item], Optional[float]]:
+        """Choose the next item to start, or return how long to wait. Called with the lock held."""
+        open_lanes = [
+            lane for lane in self.LANES
+            if self._lanes[lane] and self._in_flight[lane] < self.lane_limits[lane]
+        ]
+        if not open_lanes:
+            return None, None
+        session_wait = self.session_bucket.wait_time(now)
+        if session_wait > 0:
+            self.throttled['session'] += 1
+            return None, session_wait
+        # Smooth weighted round robin across lanes that have something to send
+        total = sum(self.weights[lane] for lane in open_lanes)
+        for lane in open_lanes:
+            self._credit[lane] += self.weights[lane]
+        shortest_wait = None
+        for lane in sorted(open_lanes, key=lambda l: self._credit[l], reverse=True):
+            queue = self._lanes[lane]
+            for index, item in enumerate(list(queue)[:self.scan_depth]):
+                if item.future.cancelled():
+                    continue
+                wait = self._recipient_bucket(item.recipient).wait_time(now)
+                if wait > 0:
+                    shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+                    continue
+                del queue[index]
+                self._credit[lane] -= total
+                return item, None
+            self.throttled['recipient'] += 1
+        for lane in open_lanes:
+            # Nobody could go; undo this round's credit so weights are not skewed by waiting
+            self._credit[lane] -= self.weights[lane]
+        return None, shortest_wait
+
+    def _drop_cancelled(self):
+        for queue in self._lanes.values():
+            while queue and queue[0].future.cancelled():
+                queue.popleft()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    self._drop_cancelled()
+                    now = time.monotonic()
+                    item, wait = self._pick(now)
+                    if item is not None:
+                        break
+                    self._cond.wait(timeout=wait)
+                if not item.future.set_running_or_notify_cancel():
+                    continue
+                item.future.started.set()
+                self.session_bucket.consume(now)
+                self._recipient_bucket(item.recipient).consume(now)
+                self._in_flight[item.lane] += 1
+                waited = now - item.enqueued_at
+                stats = self._lane_stats[item.lane]
+                stats['dispatched'] += 1
+                stats['wait_total'] += waited
+                stats['wait_max'] = max(stats['wait_max'], waited)
+                queue_wait_seconds.observe(waited, item.lane)
+                if len(self._recipient_buckets) > 10000:
+                    self._prune_recipients(now)
+            try:
+                work = self.dispatch(item.func, item.args)
+                work.add_done_callback(lambda done, item=item: self._finish(item, done))
+            except Exception as e:
+                capture_exception(e)
+                self._finish(item, None, e)
+
+    def _finish(self, item: _Item, done: Optional[Future], error: Optional[Exception] = None):
+        with self._cond:
+            self._in_flight[item.lane] -= 1
+            self._cond.notify()
+        if error is None and done is not None:
+            if done.cancelled():
+                item.future.set_result(None)
+                return
+            error = done.exception()
+            if error is None:
+                item.future.set_result(done.result())
+                return
+        item.future.set_exception(error)
+
+    def _prune_recipients(self, now: float):
+        idle = [r for r, bucket in self._recipient_buckets.items() if bucket.is_full(now)]
+        for recipient in idle:
+            del self._recipient_buckets[recipient]
+        sentry_sdk.logger.info(f"Pruned {len(idle)} idle recipient rate buckets")
+
+    def stats(self) -> Dict[str, any]:
+        now = time.monotonic()
+        with self._cond:
+            lanes = {}
+            for lane in self.LANES:
+                stats = self._lane_stats[lane]
+                queue = self._lanes[lane]
+                lanes[lane] = {
+                    'depth': len(queue),
+                    'in_flight': self._in_flight[lane],
+                    'dispatched': stats['dispatched'],
+                    'oldest_wait_seconds': round(now - queue[0].enqueued_at, 3) if queue else 0.0,
+                    'avg_wait_seconds': round(stats['wait_total'] / stats['dispatched'], 3) if stats['dispatched'] else 0.0,
+                    'max_wait_seconds': round(stats['wait_max'], 3),
+                }
+            return {'lanes': lanes, 'throttled': dict(self.throttled)}
@@ -0,0 +1,154 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+
+class SendQueue:
+    """Durable SQLite-backed queue of send jobs drained by a pool of worker threads."""
+
+    STATUSES = ('queued', 'running', 'succeeded', 'failed')
+
+    def __init__(self, handlers: Dict[str, Callable[[Dict[str, any]], Dict[str, any]]],
+                 db_path: str = "send_queue.db", workers: int = 2):
+        self.handlers = handlers
+        self.db_path = db_path
+        self.worker_count = max(1, workers)
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._workers: List[threading.Thread] = []
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+    def start(self):
+        """Requeue jobs left over from a previous run and start the worker threads."""
+        sentry_sdk.logger.info(f"Starting send queue with {self.worker_count} workers")
+        with self._lock, self._conn:
+            # A job that was running when the process died never reported back; run it again.
+            self._conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()
+        for row in rows:
+            self._pending.put(row['id'])
+        if rows:
+            sentry_sdk.logger.info(f"Recovered {len(rows)} queued jobs from {self.db_path}")
+        self._stop_event.clear()
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self._worker_loop, name=f"send-queue-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout: float = 5.0):
+        self._stop_event.set()
+        for _ in self._workers:
+            self._pending.put(None)
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+        self._workers = []
+
+    def enqueue(self, kind: str, payload: Dict[str, any]) -> str:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, kind, json.dumps(payload), time.time())
+            )
+        self._pending.put(job_id)
+        sentry_sdk.logger.info(f"Queued {kind} job {job_id}")
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return self._row_to_dict(row)
+
+    def depth(self) -> int:
+        return self._pending.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in self.STATUSES}
+        counts.update({row['status']: row['n'] for row in rows})
+        return counts
+
+    def _worker_loop(self):
+        while not self._stop_event.is_set():
+            job_id = self._pending.get()
+            if job_id is None:
+                break
+            try:
+                self._run_job(job_id)
+            except Exception as e:
+                capture_exception(e)
+
+    def _run_job(self, job_id: str):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)
+            ).fetchone()
+            if row is None:
+                return
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+        sentry_sdk.logger.info(f"Running {row['kind']} job {job_id}")
+        try:
+            result = self.handlers[row['kind']](json.loads(row['payload']))
+        except Exception as e:
+            capture_exception(e)
+            result = {'success': False, 'message': f'Error: {str(e)}'}
+        if not result:
+            result = {'success': False, 'message': 'Timeout or error in sending'}
+        status = 'succeeded' if result.get('success') else 'failed'
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result), time.time(), job_id)
+            )
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict[str, any]:
+        created_at, started_at, finished_at = row['created_at'], row['started_at'], row['finished_at']
+        return {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'wait_seconds': round(started_at - created_at, 3) if started_at else None,
+            'run_seconds': round(finished_at - started_at, 3) if started_at and finished_at else None,
+        }
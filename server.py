@@ -1,27 +1,62 @@
+import hashlib
 import os
-import csv
-import base64
 import mimetypes
 import asyncio
 import threading
 import time
 import subprocess
-from typing import Optional, Tuple, Dict
-from flask import Flask, request, jsonify
+import json
+import random
+import shutil
+import functools
+import math
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from typing import Callable, Optional, Tuple, Dict, Iterator, List
+from flask import Flask, Request, Response, request, jsonify, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 from WPP_Whatsapp import Create
 import sentry_sdk
+# Normally imported by sentry_sdk.init(); startup code logs before init_sentry() runs
+import sentry_sdk.logger
 from sentry_sdk import capture_message, capture_exception
 from sentry_sdk.integrations.flask import FlaskIntegration
+from media import (IMAGE_EXTENSIONS, WHATSAPP_IMAGE_MAX_SIDE, WHATSAPP_MAX_VIDEO_BYTES, DirectoryWatcher,
+                   ImagePipeline, MediaCache, SpoolFile, encode_base64_data_url, plan_conversion, probe_media,
+                   spool_stream, sweep_spools, target_args, target_bitrate)
+from send_queue import SendQueue
+from failures import FailureStore, normalize_phone
+from scheduler import SendScheduler, UnfinishedSends, in_progress, send_outcome
+from sessions import SessionPool
+import metrics
+from metrics import timed
+from supervisor import ConnectionSupervisor
+from acks import AckTracker, ack_status, message_id_of
+from idempotency import IdempotencyCache
 
-# Initialize Sentry
-sentry_sdk.init(
-    dsn="https://1633a41a7bdbd109b78e4c63916b9d3a@o1037254.ingest.us.sentry.io/4510005925707776",
-    send_default_pii=True,
-    traces_sample_rate=1.0,
-    integrations=[FlaskIntegration()],
-    environment="development",
-    enable_logs=True
-)
+# Remote tracing and info-level logs are sampled so the send path does not pay for every event
+SENTRY_TRACES_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE', '0.05'))
+SENTRY_LOG_SAMPLE_RATE = float(os.environ.get('SENTRY_LOG_SAMPLE_RATE', '0.05'))
+
+def _sample_logs(log, hint):
+    if log.get('severity_text') in ('trace', 'debug', 'info') and random.random() >= SENTRY_LOG_SAMPLE_RATE:
+        return None
+    return log
+
+def init_sentry():
+    """Start the Sentry client. Its transport runs worker threads, so this happens after any fork."""
+    sentry_sdk.init(
+        dsn=os.environ.get('SENTRY_DSN', "https://1633a41a7bdbd109b78e4c63916b9d3a@o1037254.ingest.us.sentry.io/4510005925707776"),
+        send_default_pii=True,
+        traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE,
+        before_send_log=_sample_logs,
+        integrations=[FlaskIntegration()],
+        environment="development",
+        enable_logs=True
+    )
+
+class ConversionFailed(Exception):
+    """FFmpeg could not run a conversion. Unlike an output that will not fit, this is worth retrying."""
 
 class WhatsAppSender:
     def __init__(self, session_name: str = "whatsapp_session"):
@@ -42,11 +77,79 @@ class WhatsAppSender:
         self.default_caption = self.video_caption
         self.video_dir = "./videos"
         self.image_dir = "./images"
-        
+        self.convertible_extensions = ('.mov', '.avi', '.mkv')
+        self.video_extensions = ('.mp4', *self.convertible_extensions)
+        self.ffmpeg_available = None
+        self.ffprobe_available = None
+        self._plans: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        self.conversion_args = (
+            '-c:v', 'libx264', '-crf', '28', '-preset', 'fast', '-c:a', 'aac', '-b:a', '128k'
+        )
+        self.media_cache = MediaCache(
+            cache_dir=os.environ.get('MEDIA_CACHE_DIR', './cache'),
+            max_disk_bytes=int(os.environ.get('MEDIA_CACHE_DISK_MB', '2048')) * 1024 * 1024,
+            max_memory_bytes=int(os.environ.get('MEDIA_CACHE_MEMORY_MB', '256')) * 1024 * 1024
+        )
+        # Images are sent as resized, upright, recompressed JPEGs cached next to converted videos
+        self.image_pipeline = None
+        if os.environ.get('IMAGE_PIPELINE', '1') == '1':
+            self.image_pipeline = ImagePipeline(
+                self.media_cache,
+                max_side=int(os.environ.get('IMAGE_MAX_SIDE', str(WHATSAPP_IMAGE_MAX_SIDE))),
+                quality=int(os.environ.get('IMAGE_QUALITY', '82')),
+                workers=int(os.environ.get('IMAGE_WORKERS', str(os.cpu_count() or 1)))
+            )
+        # Blocking client calls and media prep run on this pool so the event loop never blocks
+        self.max_in_flight = int(os.environ.get('SEND_MAX_IN_FLIGHT', '4'))
+        self.send_timeout = float(os.environ.get('SEND_TIMEOUT', '30'))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="send")
+        self._in_flight_slots = None
+        self.in_flight = 0
+        self._loop_lock = threading.Lock()
+        # Single-flight initialization: one attempt at a time, and callers that queued behind it share its result
+        self._init_lock = threading.Lock()
+        self._last_init: Optional[Tuple[float, Dict[str, any]]] = None
+        self._warmup_thread = None
+        self.warmup = {'state': 'idle', 'started_at': None, 'ready_at': None, 'error': None}
+        # Sends that land while the supervisor is reconnecting wait this long before failing
+        self.reconnect_hold = float(os.environ.get('RECONNECT_HOLD_SECONDS', '10'))
+        self.supervisor: Optional[ConnectionSupervisor] = None
+        # (session name, creator, client) of a logged-in hot standby, if one is kept
+        self.standby: Optional[Tuple[str, any, any]] = None
+        # Every accepted message is indexed by id; later delivered/read acks update it and go to the webhook.
+        # ACK_MODE=accept counts a send as successful once the client accepts it instead of requiring ack 1-3.
+        self.ack_mode = os.environ.get('ACK_MODE', 'wait')
+        self.ack_tracker = AckTracker(
+            db_path=os.environ.get('ACK_DB', 'acks.db'),
+            webhook_url=os.environ.get('ACK_WEBHOOK_URL') or None
+        )
+        self.failure_store = FailureStore(db_path=os.environ.get('FAILURE_DB', 'failures.db'))
+        # Sends that started but outlived the caller's wait; they may still be delivered, so are never replayed
+        self.unfinished = UnfinishedSends()
+        # Every send for this session is paced and prioritised here before it reaches the executor
+        self.scheduler = SendScheduler(
+            dispatch=lambda func, args: self._submit_coroutine(self._offload(func, *args)),
+            lane_limits={
+                'text': max(1, self.max_in_flight // 2),
+                'image': max(1, self.max_in_flight // 4),
+                'video': max(1, self.max_in_flight // 4),
+            },
+            session_rate=float(os.environ.get('SEND_RATE_PER_SESSION', '2')),
+            session_burst=float(os.environ.get('SEND_BURST_PER_SESSION', '10')),
+            recipient_rate=float(os.environ.get('SEND_RATE_PER_RECIPIENT', '0.5')),
+            recipient_burst=float(os.environ.get('SEND_BURST_PER_RECIPIENT', '3'))
+        )
+
     def check_if_initialized(self) -> bool:
         sentry_sdk.logger.info("Checking if WhatsApp client is initialized")
+        return self._connected()
+
+    def _connected(self) -> bool:
         return self.creator is not None and self.creator.state == 'CONNECTED'
 
+    def connection_state(self) -> Optional[str]:
+        return self.creator.state if self.creator is not None else None
+
     def _create_event_loop(self) -> asyncio.AbstractEventLoop:
         sentry_sdk.logger.info("Creating new event loop")
         if self.loop is None:
@@ -54,22 +157,69 @@ class WhatsAppSender:
             asyncio.set_event_loop(self.loop)
         return self.loop
 
-    def _run_async_in_thread(self, coro):
-        sentry_sdk.logger.info("Running async coroutine in thread")
-        if self.thread is None or not self.thread.is_alive():
-            self._create_event_loop()
-            self.thread = threading.Thread(target=self._run_loop, daemon=True)
-            self.thread.start()
-        while self.loop is None or not self.loop.is_running():
-            time.sleep(0.1)
-            
-        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+    def _submit_coroutine(self, coro) -> Future:
+        with self._loop_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self._create_event_loop()
+                self.thread = threading.Thread(target=self._run_loop, daemon=True)
+                self.thread.start()
+            while self.loop is None or not self.loop.is_running():
+                time.sleep(0.1)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _run_scheduled(self, lane: str, phone_number: str, func, *args,
+                       on_failure: Optional[Callable[[Dict[str, any]], any]] = None):
+        return self._await_scheduled(self.scheduler.submit(lane, phone_number.replace('+', ''), func, *args),
+                                     on_failure)
+
+    def _await_scheduled(self, future, on_failure: Optional[Callable[[Dict[str, any]], any]] = None):
+        """Give a scheduled send send_timeout to leave its lane, then send_timeout to finish.
+
+        A send still queued at the first deadline is withdrawn and reported as a timeout. One that has
+        started is never reported as failed, because the upload may still land: the caller gets an
+        in-progress result with a send_id (see settle()) and on_failure runs only if it really fails.
+        """
+        if not future.started.wait(self.send_timeout) and future.cancel():
+            return None
         try:
-            return future.result(timeout=30.0)
+            return future.result(timeout=self.send_timeout)
+        except FuturesTimeoutError:
+            sentry_sdk.logger.warning("Send still running after send_timeout; reporting it as in progress")
+            return in_progress(self.unfinished.add(future, on_failure))
         except Exception as e:
             capture_exception(e)
             return None
 
+    def unfinished_send(self, send_id: Optional[str]) -> Optional[Future]:
+        return self.unfinished.get(send_id)
+
+    def settle(self, result: Optional[Dict[str, any]], timeout: Optional[float] = None) -> Optional[Dict[str, any]]:
+        """Wait for a send reported as in progress to finish; any other result is returned as is."""
+        return self.unfinished.settle(result, timeout)
+
+    def _failure_recorder(self, phone_number: str, file_path: str, kind: str, caption: Optional[str]):
+        return lambda result: self.record_failure(
+            phone_number, file_path, kind, f"File sending failed: {result.get('message', 'Unknown error')}", caption
+        )
+
+    async def _offload(self, func, *args):
+        """Run a blocking call on the executor, holding one of max_in_flight slots until the call returns."""
+        if self._in_flight_slots is None:
+            # Created on first use so it belongs to the loop thread's event loop
+            self._in_flight_slots = asyncio.Semaphore(self.max_in_flight)
+        await self._in_flight_slots.acquire()
+        self.in_flight += 1
+        work = asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+        def release(_):
+            self.in_flight -= 1
+            self._in_flight_slots.release()
+
+        # The slot belongs to the executor thread, not to this coroutine: a caller that times out and
+        # cancels us must not free it while the thread is still sending
+        work.add_done_callback(release)
+        return await asyncio.shield(work)
+
     def _run_loop(self):
         sentry_sdk.logger.info("Starting event loop thread")
         self.loop = asyncio.new_event_loop()
@@ -84,11 +234,7 @@ class WhatsAppSender:
         if self.check_if_initialized():
             return
         try:
-            sentry_sdk.logger.info("Creating WhatsApp client")
-            self.creator = Create(session=self.session)
-            self.client = self.creator.start()
-            if self.creator.state != 'CONNECTED':
-                raise Exception(f"Connection failed: {self.creator.state}")
+            self.creator, self.client = self._connect(self.session)
             sentry_sdk.logger.info("WhatsApp client initialized successfully")
         except asyncio.TimeoutError:
             raise Exception("Timeout initializing WhatsApp client - please scan QR code")
@@ -96,44 +242,263 @@ class WhatsAppSender:
             capture_exception(e)
             raise Exception(f"Failed to initialize WhatsApp client: {str(e)}")
 
+    def _connect(self, session: str) -> Tuple[any, any]:
+        sentry_sdk.logger.info(f"Creating WhatsApp client for session {session}")
+        creator = Create(session=session)
+        client = creator.start()
+        if creator.state != 'CONNECTED':
+            raise Exception(f"Connection failed: {creator.state}")
+        if hasattr(client, 'onAck'):
+            client.onAck(self.ack_tracker.on_ack)
+        return creator, client
+
     def initialize(self) -> Dict[str, any]:
+        """Connect the client. Concurrent callers wait for the attempt in progress instead of starting their own."""
         sentry_sdk.logger.info("Starting WhatsApp client initialization")
-        def init_coro():
-            self._initialize_async()
+        requested_at = time.time()
+        with self._init_lock:
+            if self.check_if_initialized():
+                return {'success': True, 'message': 'Initialization successful'}
+            if self._last_init and self._last_init[0] >= requested_at:
+                return self._last_init[1]
+            self.warmup.update(state='warming', started_at=time.time(), error=None)
+            try:
+                with timed('session_start'):
+                    self._initialize_async()
+                self.warmup.update(state='ready', ready_at=time.time())
+                result = {'success': True, 'message': 'Initialization successful'}
+            except Exception as e:
+                capture_exception(e)
+                self.warmup.update(state='failed', error=str(e))
+                result = {'success': False, 'message': f'Initialization failed: {str(e)}'}
+            self._last_init = (time.time(), result)
+            return result
+
+    def initializing(self) -> bool:
+        return self._init_lock.locked() or (self._warmup_thread is not None and self._warmup_thread.is_alive())
+
+    def reconnect(self) -> Dict[str, any]:
+        """Drop the dead client and log in again through the single-flight initialize."""
+        sentry_sdk.logger.warning(f"Reconnecting WhatsApp session {self.session}")
+        client = self.client
+        if client is not None:
+            try:
+                client.close()
+            except Exception as e:
+                capture_exception(e)
+        return self.initialize()
+
+    def connect_standby(self, session: str) -> bool:
+        """Log a second session in and keep it ready for promote_standby()."""
         try:
-            self._run_async_in_thread(init_coro())
-            return {'success': True, 'message': 'Initialization successful'}
+            with timed('standby_start'):
+                creator, client = self._connect(session)
+            self.standby = (session, creator, client)
+            sentry_sdk.logger.info(f"Standby session {session} connected")
+            return True
         except Exception as e:
             capture_exception(e)
-            return {'success': False, 'message': f'Initialization failed: {str(e)}'}
+            return False
+
+    def standby_connected(self) -> bool:
+        return self.standby is not None and self.standby[1].state == 'CONNECTED'
+
+    def promote_standby(self) -> str:
+        """Swap the standby in as the primary client; returns the name of the session it replaced."""
+        with self._init_lock:
+            old_session, old_client = self.session, self.client
+            self.session, self.creator, self.client = self.standby
+            self.standby = None
+            self.warmup.update(state='ready', ready_at=time.time(), error=None)
+        if old_client is not None:
+            try:
+                old_client.close()
+            except Exception as e:
+                capture_exception(e)
+        return old_session
+
+    def start_supervisor(self, standby_session: Optional[str] = None):
+        """Watch the connection in the background and reconnect (or promote the standby) when it drops."""
+        self.supervisor = ConnectionSupervisor(
+            self,
+            interval=float(os.environ.get('SUPERVISOR_INTERVAL', '2')),
+            base_delay=float(os.environ.get('RECONNECT_BASE_DELAY', '2')),
+            max_delay=float(os.environ.get('RECONNECT_MAX_DELAY', '60')),
+            standby_session=standby_session,
+            grace=float(os.environ.get('SUPERVISOR_GRACE_SECONDS', '20'))
+        )
+        self.supervisor.start()
+
+    def _poll_ack(self, message_id: str) -> Optional[int]:
+        message = self.client.getMessageById(message_id)
+        return message.get('ack') if isinstance(message, dict) else None
+
+    def start_ack_polling(self):
+        """Poll acks of open messages, for client versions whose onAck event never fires."""
+        self.ack_tracker.start_polling(
+            self._poll_ack, self._connected, lambda: self.session,
+            interval=float(os.environ.get('ACK_POLL_INTERVAL', '30'))
+        )
+
+    def _track_send(self, kind: str, phone_number: str, result, acked: bool) -> Tuple[bool, Dict[str, any]]:
+        """Index an accepted message for ack tracking; returns (success, fields for the response)."""
+        if not isinstance(result, dict):
+            return acked, {}
+        message_id = message_id_of(result)
+        ack = result.get('ack')
+        if not message_id:
+            return acked, {}
+        self.ack_tracker.track(message_id, phone_number, kind, ack, self.session)
+        success = acked or (self.ack_mode == 'accept' and ack != -1)
+        return success, {'message_id': message_id, 'ack_status': ack_status(ack)}
+
+    def start_warmup(self):
+        """Initialize on a background thread so startup and requests never wait on the browser."""
+        if self._connected() or self.initializing():
+            return
+        if self.supervisor is not None and self.supervisor.is_running() and self.warmup['state'] != 'idle':
+            # Reconnects after the first login are the supervisor's job, paced by its backoff
+            return
+        self.warmup.update(state='warming', started_at=time.time(), error=None)
+        self._warmup_thread = threading.Thread(target=self.initialize, name=f"warmup-{self.session}", daemon=True)
+        self._warmup_thread.start()
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Wait up to timeout for the client to connect; gives up early if nothing is trying to connect it."""
+        deadline = time.monotonic() + timeout
+        while not self._connected():
+            recovering = self.initializing() or (self.supervisor is not None and self.supervisor.is_running())
+            if not recovering or time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def readiness(self) -> Dict[str, any]:
+        ready = self.check_if_initialized()
+        started_at = self.warmup['started_at']
+        state = self.warmup['state']
+        if not ready and self.supervisor is not None and self.supervisor.down_since is not None:
+            state = 'reconnecting'
+        return {
+            'ready': ready,
+            'state': 'ready' if ready else state,
+            'warming_seconds': round(time.time() - started_at, 1) if started_at and not ready else None,
+            'error': None if ready else self.warmup['error']
+        }
 
     def check_ffmpeg(self) -> bool:
+        """Probe for FFmpeg and ffprobe once; later calls return the cached answer."""
+        if self.ffmpeg_available is not None:
+            return self.ffmpeg_available
         sentry_sdk.logger.info("Checking if FFmpeg is installed")
         try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            return True
+            with timed('ffmpeg_probe'):
+                subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+            self.ffmpeg_available = True
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             capture_exception(e)
             capture_message("FFmpeg not installed. Run 'sudo pacman -S ffmpeg' to enable conversion.", level="warning")
+            self.ffmpeg_available = False
+            self.ffprobe_available = False
             return False
+        try:
+            subprocess.run(['ffprobe', '-version'], capture_output=True, check=True)
+            self.ffprobe_available = True
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            capture_exception(e)
+            capture_message("ffprobe not found; converting by file extension only.", level="warning")
+            self.ffprobe_available = False
+        return True
 
-    def convert_to_mp4(self, input_path: str, output_path: str) -> bool:
+    def convert_to_mp4(self, input_path: str, output_path: str, args: Optional[Tuple[str, ...]] = None) -> bool:
         sentry_sdk.logger.info(f"Converting video to MP4: {input_path}")
         if not self.check_ffmpeg():
             return False
         try:
-            subprocess.run([
-                'ffmpeg', '-i', input_path, '-c:v', 'libx264', '-crf', '28',
-                '-preset', 'fast', '-c:a', 'aac', '-b:a', '128k', output_path
-            ], capture_output=True, check=True)
+            with timed('conversion'):
+                subprocess.run(
+                    ['ffmpeg', '-y', '-i', input_path, *(args or self.conversion_args), output_path],
+                    capture_output=True, check=True
+                )
             sentry_sdk.logger.info(f"Converted video to {output_path}")
             return True
         except subprocess.CalledProcessError as e:
             capture_exception(e)
             return False
 
+    def convert_to_size(self, input_path: str, output_path: str, args: Tuple[str, ...],
+                        max_bytes: int = WHATSAPP_MAX_VIDEO_BYTES, attempts: int = 3) -> bool:
+        """Size-targeted encode: re-encode at a lower bitrate until the output fits max_bytes.
+
+        Returns False if it still does not fit; raises ConversionFailed if FFmpeg itself failed.
+        """
+        headroom = 0.9
+        for attempt in range(attempts):
+            if not self.convert_to_mp4(input_path, output_path, args):
+                # A killed process or a full disk says nothing about whether the file can fit
+                raise ConversionFailed(f"FFmpeg could not convert {input_path}")
+            size = os.path.getsize(output_path)
+            if size <= max_bytes:
+                return True
+            probe = probe_media(output_path) if self.ffprobe_available else None
+            if not probe or not probe['duration'] or attempt == attempts - 1:
+                break
+            # Aim lower by however much this attempt overshot
+            headroom *= max_bytes / size * 0.95
+            video_bps = target_bitrate(max_bytes, probe['duration'], headroom=headroom)
+            if video_bps is None:
+                break
+            sentry_sdk.logger.warning(f"{input_path} encoded to {size} bytes; retrying at {video_bps}bps")
+            args = target_args(video_bps)
+        sentry_sdk.logger.error(f"Could not fit {input_path} under {max_bytes} bytes")
+        return False
+
+    def plan_conversion(self, file_path: str) -> Tuple[str, Tuple[str, ...]]:
+        """Decide between sending as-is, remuxing, transcoding or a size-targeted encode."""
+        digest = self.media_cache.source_digest(file_path)
+        plan = self._plans.get(digest)
+        if plan is None:
+            probe = probe_media(file_path) if self.check_ffmpeg() and self.ffprobe_available else None
+            if probe is not None:
+                plan = plan_conversion(file_path, probe, self.conversion_args)
+            elif os.path.getsize(file_path) > WHATSAPP_MAX_VIDEO_BYTES:
+                plan = ('target', self.conversion_args)
+            elif file_path.lower().endswith(self.convertible_extensions):
+                plan = ('transcode', self.conversion_args)
+            else:
+                plan = ('none', ())
+            self._plans[digest] = plan
+            sentry_sdk.logger.info(f"Conversion plan for {file_path}: {plan[0]}")
+        return plan
+
+    def _convert_cached(self, file_path: str, action: str, args: Tuple[str, ...]) -> Optional[str]:
+        convert = self.convert_to_size if action == 'target' else self.convert_to_mp4
+        converted_path = self.media_cache.get_converted(
+            file_path, ' '.join(args), '.mp4',
+            lambda input_path, output_path: convert(input_path, output_path, args)
+        )
+        if converted_path is None and action == 'target':
+            # The encodes ran and overshot; remember it so later sends fail fast instead of repeating them
+            self._plans[self.media_cache.source_digest(file_path)] = ('too_large', ())
+        return converted_path
+
+    def pretranscode(self, file_path: str) -> Optional[str]:
+        """Convert a video into the media cache, or wait for an in-flight conversion of it."""
+        action, args = self.plan_conversion(file_path)
+        if not args:
+            return None
+        try:
+            return self._convert_cached(file_path, action, args)
+        except ConversionFailed as e:
+            # Sends will try again, and report it if it still fails
+            capture_exception(e)
+            return None
+
     def encode_video_to_base64(self, file_path: str, use_data_url: bool = True, convert: bool = False) -> Optional[Tuple[str, str]]:
-        """Encode a video file to base64."""
+        """Encode a video file to base64, reusing cached conversions and payloads.
+
+        Raises ConversionFailed when FFmpeg fails on a file that has to be shrunk to be sent at all.
+        """
         if not os.path.exists(file_path):
             sentry_sdk.logger.error(f"File not found at {file_path}")
             return None
@@ -141,31 +506,43 @@ class WhatsAppSender:
         if not mime_type or not mime_type.startswith('video/'):
             mime_type = 'video/mp4'
             sentry_sdk.logger.warning(f"Could not detect MIME type, using {mime_type}")
-        working_path = file_path
-        if convert and file_path.lower().endswith(('.mov', '.avi', '.mkv')):
-            temp_path = f"{os.path.splitext(file_path)[0]}_converted.mp4"
-            if self.convert_to_mp4(file_path, temp_path):
-                working_path = temp_path
-                mime_type = 'video/mp4'
-                sentry_sdk.logger.info(f"Converted to {temp_path}")
-            else:
-                sentry_sdk.logger.warning("Continuing with original file due to conversion failure")
-        file_size_mb = os.path.getsize(working_path) / (1024 * 1024)
-        if file_size_mb > 50:
-            sentry_sdk.logger.warning(f"File size ({file_size_mb:.2f}MB) exceeds WhatsApp's 50MB limit.")
         try:
-            with open(working_path, 'rb') as f:
-                base64_bytes = base64.b64encode(f.read())
-            base64_str = base64_bytes.decode('utf-8')
-            if use_data_url:
-                base64_str = f"data:{mime_type};base64,{base64_str}"
-            if convert and working_path != file_path and os.path.exists(working_path):
-                os.remove(working_path)
-                sentry_sdk.logger.info(f"Cleaned up temporary file: {working_path}")
+            action, args = self.plan_conversion(file_path) if convert else ('none', ())
+            if action == 'too_large':
+                sentry_sdk.logger.error(f"{file_path} cannot be compressed under WhatsApp's size limit")
+                return None
+            needs_conversion = bool(args)
+            settings = ' '.join(args) if needs_conversion else 'original'
+            payload_key = self.media_cache.make_key(file_path, f"{settings}|data_url={use_data_url}")
+            cached = self.media_cache.get_payload(payload_key)
+            if cached:
+                sentry_sdk.logger.info(f"Using cached payload for {file_path}")
+                return cached
+            working_path = file_path
+            if needs_conversion:
+                converted_path = self._convert_cached(file_path, action, args)
+                if converted_path:
+                    working_path = converted_path
+                    mime_type = 'video/mp4'
+                    sentry_sdk.logger.info(f"Using {action} output {converted_path}")
+                elif action == 'target':
+                    # The original is over the limit; sending it would only fail on WhatsApp's side
+                    return None
+                else:
+                    sentry_sdk.logger.warning("Continuing with original file due to conversion failure")
+            file_size_mb = os.path.getsize(working_path) / (1024 * 1024)
+            if file_size_mb > 50:
+                sentry_sdk.logger.warning(f"File size ({file_size_mb:.2f}MB) exceeds WhatsApp's 50MB limit.")
+            base64_str = encode_base64_data_url(working_path, mime_type, use_data_url=use_data_url)
+            if working_path != file_path or not needs_conversion:
+                # Only cache payloads of what we meant to send, not of a failed-conversion fallback
+                self.media_cache.put_payload(payload_key, base64_str, mime_type)
             return base64_str, mime_type
         except MemoryError:
             sentry_sdk.logger.error("File too large for base64 encoding.")
             return None
+        except ConversionFailed:
+            raise
         except Exception as e:
             capture_exception(e)
             return None
@@ -173,73 +550,101 @@ class WhatsAppSender:
     def _send_message_async(self, phone_number: str, message: str) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending message asynchronously")
         try:
-            if not self.check_if_initialized():
+            if not self._connected() and not self.wait_until_ready(self.reconnect_hold):
                 raise Exception("WhatsApp client not initialized.")
             if not phone_number or not message:
                 return {'success': False, 'message': 'Phone number and message are required'}
             phone_number = phone_number.replace('+', '')
             sentry_sdk.logger.info(f"Sending message to {phone_number}: {message[:50]}...")
-            result = self.client.sendText(phone_number, message)
-            if result:
+            with timed('client_send_text'):
+                result = self.client.sendText(phone_number, message)
+            success, tracking = self._track_send('text', phone_number, result, bool(result))
+            if success:
                 sentry_sdk.logger.info(f"Message sent successfully to {phone_number}")
-                return {'success': True, 'message': 'Message sent successfully'}
+                metrics.sends_total.inc(1, 'text', 'success')
+                metrics.bytes_sent_total.inc(len(message.encode('utf-8')), 'text')
+                return {'success': True, 'message': 'Message sent successfully', **tracking}
             else:
                 sentry_sdk.logger.warning(f"Failed to send message to {phone_number}")
+                metrics.sends_total.inc(1, 'text', 'failure')
                 return {'success': False, 'message': 'Failed to send message'}
         except Exception as e:
             capture_exception(e)
             return {'success': False, 'message': f'Error: {str(e)}'}
 
-    def _send_video_file_async(self, phone_number: str, file_path: str) -> Dict[str, any]:
+    def _send_video_file_async(self, phone_number: str, file_path: str, caption: Optional[str] = None,
+                               payload: Optional[Tuple[str, str]] = None) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending video file asynchronously")
         try:
-            if not self.check_if_initialized():
+            if not self._connected() and not self.wait_until_ready(self.reconnect_hold):
                 raise Exception("WhatsApp client not initialized.")
             if not phone_number or not file_path:
                 return {'success': False, 'message': 'Phone number and file path are required'}
             phone_number = phone_number.replace('+', '')
             chat_id = f"{phone_number}@c.us"
             sentry_sdk.logger.info(f"Sending video to {chat_id}: {file_path}...")
-            base64_str, mime_type = self.encode_video_to_base64(file_path, use_data_url=True, convert=True)
+            if payload is None:
+                payload = self.encode_video_to_base64(file_path, use_data_url=True, convert=True)
+            base64_str, mime_type = payload or (None, None)
             if not base64_str:
                 return {'success': False, 'message': 'Failed to encode file to base64'}
-            result = self.client.sendFile(
-                chat_id,
-                base64_str,
-                os.path.basename(file_path),
-                self.video_caption
-            )
-            if result and result.get('ack') in [1, 2, 3]:
+            # sendFile returns once WhatsApp Web acknowledges the message, so this includes the ack wait
+            with timed('client_send_file'):
+                result = self.client.sendFile(
+                    chat_id,
+                    base64_str,
+                    os.path.basename(file_path),
+                    caption if caption is not None else self.video_caption
+                )
+            acked = bool(result) and result.get('ack') in [1, 2, 3]
+            success, tracking = self._track_send('video', phone_number, result, acked)
+            if success:
                 sentry_sdk.logger.info(f"Video sent successfully to {phone_number}")
-                return {'success': True, 'message': 'File sent successfully'}
+                # Whatever earlier attempts recorded, the guest has the file now
+                self.failure_store.resolve(phone_number, file_path)
+                metrics.sends_total.inc(1, 'video', 'success')
+                metrics.bytes_sent_total.inc(len(base64_str), 'video')
+                return {'success': True, 'message': 'File sent successfully', **tracking}
             else:
                 sentry_sdk.logger.warning(f"Failed to send video to {phone_number}: {result}")
+                metrics.sends_total.inc(1, 'video', 'failure')
                 return {'success': False, 'message': f'Failed to send file: {result}'}
         except Exception as e:
             capture_exception(e)
             return {'success': False, 'message': f'Error: {str(e)}'}
 
-    def _send_image_file_async(self, phone_number: str, file_path: str) -> Dict[str, any]:
+    def _send_image_file_async(self, phone_number: str, file_path: str, caption: Optional[str] = None) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending image file asynchronously")
         try:
-            if not self.check_if_initialized():
+            if not self._connected() and not self.wait_until_ready(self.reconnect_hold):
                 raise Exception("WhatsApp client not initialized.")
             if not phone_number or not file_path:
                 return {'success': False, 'message': 'Phone number and file path are required'}
             phone_number = phone_number.replace('+', '')
             chat_id = f"{phone_number}@c.us"
             sentry_sdk.logger.info(f"Sending image to {chat_id}: {file_path}...")
-            result = self.client.sendImage(
-                chat_id,
-                file_path,
-                os.path.basename(file_path),
-                self.image_caption
-            )
-            if result and result.get('ack') in [1, 2, 3]:
+            send_path, file_name = file_path, os.path.basename(file_path)
+            derivative = self.image_pipeline.derivative(file_path) if self.image_pipeline else None
+            if derivative:
+                send_path, file_name = derivative, os.path.splitext(file_name)[0] + '.jpg'
+            with timed('client_send_image'):
+                result = self.client.sendImage(
+                    chat_id,
+                    send_path,
+                    file_name,
+                    caption if caption is not None else self.image_caption
+                )
+            acked = bool(result) and result.get('ack') in [1, 2, 3]
+            success, tracking = self._track_send('image', phone_number, result, acked)
+            if success:
                 sentry_sdk.logger.info(f"Image sent successfully to {phone_number}")
-                return {'success': True, 'message': 'File sent successfully'}
+                self.failure_store.resolve(phone_number, file_path)
+                metrics.sends_total.inc(1, 'image', 'success')
+                metrics.bytes_sent_total.inc(os.path.getsize(send_path), 'image')
+                return {'success': True, 'message': 'File sent successfully', **tracking}
             else:
                 sentry_sdk.logger.warning(f"Failed to send image to {phone_number}: {result}")
+                metrics.sends_total.inc(1, 'image', 'failure')
                 return {'success': False, 'message': f'Failed to send file: {result}'}
         except Exception as e:
             capture_exception(e)
@@ -247,90 +652,159 @@ class WhatsAppSender:
 
     def send_message(self, phone_number: str, message: str) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending message synchronously")
-        async def send_coro():
-            return self._send_message_async(phone_number, message)
-        result = self._run_async_in_thread(send_coro())
+        result = self._run_scheduled('text', phone_number, self._send_message_async, phone_number, message)
         return result if result else {'success': False, 'message': 'Timeout or error in message sending'}
 
-    def send_video_file(self, phone_number: str, file_path: str) -> Dict[str, any]:
+    def send_video_file(self, phone_number: str, file_path: str, caption: Optional[str] = None,
+                        record_failures: bool = True) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending video file synchronously")
         if not os.path.exists(file_path):
             sentry_sdk.logger.error(f"File not found: {file_path}")
-            fallback_result = self.save_to_csv(phone_number, file_path)
-            return {
-                'success': False,
-                'message': f'File not found: {file_path}. Fallback: {fallback_result}'
-            }
-        async def send_coro():
-            return self._send_video_file_async(phone_number, file_path)
+            message = f'File not found: {file_path}'
+            if record_failures:
+                message += f'. Fallback: {self.record_failure(phone_number, file_path, "video", message, caption)}'
+            return {'success': False, 'message': message}
         try:
-            result = self._run_async_in_thread(send_coro())
-            if result and result.get('success', False):
+            on_failure = self._failure_recorder(phone_number, file_path, 'video', caption) if record_failures else None
+            result = self._run_scheduled('video', phone_number, self._send_video_file_async, phone_number, file_path, caption,
+                                         on_failure=on_failure)
+            if result and (result.get('success', False) or result.get('in_progress')):
                 return result
-            else:
-                fallback_result = self.save_to_csv(phone_number, file_path)
-                return {
-                    'success': False,
-                    'message': f"File sending failed: {result.get('message', 'Unknown error')}. Fallback: {fallback_result}"
-                }
+            error = result.get('message', 'Unknown error') if result else 'Timeout or error in sending'
+            message = f"File sending failed: {error}"
         except Exception as e:
             capture_exception(e)
-            fallback_result = self.save_to_csv(phone_number, file_path)
-            return {
-                'success': False,
-                'message': f"Error sending file: {str(e)}. Fallback: {fallback_result}"
-            }
+            message = f"Error sending file: {str(e)}"
+        if record_failures:
+            message += f". Fallback: {self.record_failure(phone_number, file_path, 'video', message, caption)}"
+        return {'success': False, 'message': message}
 
-    def send_image_file(self, phone_number: str, file_path: str) -> Dict[str, any]:
+    def send_image_file(self, phone_number: str, file_path: str, caption: Optional[str] = None,
+                        record_failures: bool = True) -> Dict[str, any]:
         sentry_sdk.logger.info("Sending image file synchronously")
         if not os.path.exists(file_path):
             sentry_sdk.logger.error(f"File not found: {file_path}")
-            fallback_result = self.save_to_csv(phone_number, file_path)
-            return {
-                'success': False,
-                'message': f'File not found: {file_path}. Fallback: {fallback_result}'
-            }
-        async def send_coro():
-            return self._send_image_file_async(phone_number, file_path)
+            message = f'File not found: {file_path}'
+            if record_failures:
+                message += f'. Fallback: {self.record_failure(phone_number, file_path, "image", message, caption)}'
+            return {'success': False, 'message': message}
         try:
-            result = self._run_async_in_thread(send_coro())
-            if result and result.get('success', False):
+            on_failure = self._failure_recorder(phone_number, file_path, 'image', caption) if record_failures else None
+            result = self._run_scheduled('image', phone_number, self._send_image_file_async, phone_number, file_path, caption,
+                                         on_failure=on_failure)
+            if result and (result.get('success', False) or result.get('in_progress')):
                 return result
-            else:
-                fallback_result = self.save_to_csv(phone_number, file_path)
-                return {
-                    'success': False,
-                    'message': f"File sending failed: {result.get('message', 'Unknown error')}. Fallback: {fallback_result}"
-                }
+            error = result.get('message', 'Unknown error') if result else 'Timeout or error in sending'
+            message = f"File sending failed: {error}"
         except Exception as e:
             capture_exception(e)
-            fallback_result = self.save_to_csv(phone_number, file_path)
-            return {
-                'success': False,
-                'message': f"Error sending file: {str(e)}. Fallback: {fallback_result}"
-            }
+            message = f"Error sending file: {str(e)}"
+        if record_failures:
+            message += f". Fallback: {self.record_failure(phone_number, file_path, 'image', message, caption)}"
+        return {'success': False, 'message': message}
 
-    def save_to_csv(self, phone_number: str, file_path: str) -> str:
-        sentry_sdk.logger.error(f"ERROR: Saving failed send attempt to CSV: {phone_number}, {file_path}")
-        csv_file = "error_files.csv"
-        headers = ['Phone Number', 'File Path']
+    def iter_batch(self, kind: str, recipients: List[Dict[str, any]], file_path: Optional[str] = None,
+                   message: Optional[str] = None, caption: Optional[str] = None) -> Iterator[Dict[str, any]]:
+        """Prepare one payload and send it to each recipient, yielding per-recipient results."""
+        sentry_sdk.logger.info(f"Sending {kind} batch to {len(recipients)} recipients")
+        payload = None
+        if kind in ('video', 'image') and not os.path.exists(file_path):
+            sentry_sdk.logger.error(f"File not found: {file_path}")
+            message = f'File not found: {file_path}'
+            for recipient in recipients:
+                fallback_result = self.record_failure(recipient['phone_number'], file_path, kind, message,
+                                                      recipient.get('caption', caption))
+                yield {
+                    'phone_number': recipient['phone_number'],
+                    'success': False,
+                    'message': f'{message}. Fallback: {fallback_result}'
+                }
+            return
+        if kind == 'video':
+            try:
+                payload = self.encode_video_to_base64(file_path, use_data_url=True, convert=True)
+                error = None if payload else 'Failed to encode file to base64'
+            except ConversionFailed as e:
+                capture_exception(e)
+                error = f'Error: {str(e)}'
+            if error:
+                # Each recipient would only repeat the same failing encode
+                for recipient in recipients:
+                    yield self._batch_result(kind, recipient['phone_number'], recipient.get('caption', caption),
+                                             file_path, {'success': False, 'message': error})
+                return
+        # Queue every send at once; the scheduler paces them through the client
+        futures = {}
+        for recipient in recipients:
+            phone_number = recipient['phone_number']
+            recipient_caption = recipient.get('caption', caption)
+            key = phone_number.replace('+', '')
+            if kind == 'text':
+                future = self.scheduler.submit('text', key, self._send_message_async, phone_number,
+                                               recipient.get('message', message))
+            elif kind == 'video':
+                future = self.scheduler.submit('video', key, self._send_video_file_async, phone_number,
+                                               file_path, recipient_caption, payload)
+            else:
+                future = self.scheduler.submit('image', key, self._send_image_file_async, phone_number,
+                                               file_path, recipient_caption)
+            futures[future] = (phone_number, recipient_caption)
+        # Sends go through their lane at most lane_limit at a time, each allowed send_timeout
+        waves = math.ceil(len(recipients) / self.scheduler.lane_limits[kind])
+        deadline = time.time() + self.send_timeout * max(1, waves)
+        yielded = set()
         try:
-            file_exists = os.path.isfile(csv_file)
-            with open(csv_file, mode='a', newline='') as file:
-                writer = csv.writer(file)
-                if not file_exists:
-                    writer.writerow(headers)
-                writer.writerow([phone_number, file_path])
-            sentry_sdk.logger.warning(f"Data successfully appended to {csv_file}")
-            return f"Data successfully appended to {csv_file}"
+            for future in as_completed(futures, timeout=max(0.0, deadline - time.time())):
+                yielded.add(future)
+                yield self._batch_result(kind, *futures[future], file_path, send_outcome(future))
+        except FuturesTimeoutError:
+            for future, (phone_number, recipient_caption) in futures.items():
+                if future in yielded:
+                    continue
+                if future.done():
+                    result = send_outcome(future)
+                elif future.cancel():
+                    # Never started, so nothing reached WhatsApp; safe to record for replay
+                    result = None
+                else:
+                    on_failure = None if kind == 'text' else self._failure_recorder(
+                        phone_number, file_path, kind, recipient_caption)
+                    result = in_progress(self.unfinished.add(future, on_failure))
+                yield self._batch_result(kind, phone_number, recipient_caption, file_path, result)
+
+    def _batch_result(self, kind: str, phone_number: str, caption: Optional[str], file_path: Optional[str],
+                      result: Optional[Dict[str, any]]) -> Dict[str, any]:
+        result = result or {'success': False, 'message': 'Timeout or error in sending'}
+        if not result.get('success') and not result.get('in_progress') and kind != 'text':
+            fallback_result = self.record_failure(phone_number, file_path, kind, result.get('message'), caption)
+            result = {**result, 'message': f"{result.get('message')}. Fallback: {fallback_result}"}
+        return {'phone_number': phone_number, **result}
+
+    def record_failure(self, phone_number: str, file_path: str, kind: str, message: str,
+                       caption: Optional[str] = None) -> str:
+        sentry_sdk.logger.error(f"ERROR: Recording failed send attempt: {phone_number}, {file_path}")
+        try:
+            failure = self.failure_store.record(phone_number, file_path, kind, message, caption)
+            if failure['status'] == 'permanent':
+                return f"Recorded as failure #{failure['id']} ({failure['error_class']}, not retried)"
+            return f"Recorded as failure #{failure['id']} ({failure['error_class']}) for automatic retry"
         except Exception as e:
             capture_exception(e)
-            return f"Failed to append to {csv_file}: {str(e)}"
+            return f"Failed to record failure: {str(e)}"
 
     def close(self):
         """Cleanly close the WhatsApp client and event loop."""
         sentry_sdk.logger.info("Closing WhatsApp client and event loop")
         try:
+            if self.supervisor:
+                self.supervisor.stop()
+            if self.standby:
+                self.standby[2].close()
+            self.scheduler.stop()
+            if self.image_pipeline:
+                self.image_pipeline.close()
+            self.ack_tracker.stop()
+            self.executor.shutdown(wait=False, cancel_futures=True)
             if self.loop and self.loop.is_running():
                 def close_coro():
                     if self.client:
@@ -345,15 +819,249 @@ class WhatsAppSender:
             capture_exception(e)
 
 # Flask application setup
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', './uploads')
+
+class SpoolingRequest(Request):
+    """Write multipart file parts straight to a hashing spool file on disk, whatever their size.
+
+    Every spool is tracked on the request and deleted when it ends, unless it was moved into place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spools: List[SpoolFile] = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = SpoolFile(UPLOAD_SPOOL_DIR)
+        self.spools.append(spool)
+        return spool
+
 app = Flask(__name__)
-whatsapp_sender = WhatsAppSender()
-whatsapp_sender.initialize()
+app.request_class = SpoolingRequest
+
+@app.teardown_request
+def discard_spools(error=None):
+    # Covers truncated uploads and multipart bodies parsed by any route, not only /upload
+    for spool in getattr(request, 'spools', ()):
+        try:
+            spool.discard()
+        except Exception as e:
+            capture_exception(e)
+
+# Spools only live for the length of a request, so any found at startup were abandoned by a crash
+swept = sweep_spools(UPLOAD_SPOOL_DIR)
+if swept:
+    sentry_sdk.logger.info(f"Removed {swept} abandoned upload spool files from {UPLOAD_SPOOL_DIR}")
+
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', '512')) * 1024 * 1024
+# Keep the session name stable across restarts so the saved login is reused instead of a new QR scan
+whatsapp_sender = WhatsAppSender(session_name=os.environ.get('WHATSAPP_SESSION', 'whatsapp_session'))
+
+def _session_sender(name: str) -> WhatsAppSender:
+    # Runs first thing in a forked session worker, which starts its own Sentry client. Session workers
+    # are daemonic and cannot fork an image pool: they optimize images themselves, on cache misses only
+    init_sentry()
+    return WhatsAppSender(session_name=name)
+
+# Multi-session mode: WHATSAPP_SESSIONS="booth1,booth2" runs one worker process per session.
+# Workers are forked here, before Sentry or anything else has started a thread in this process;
+# constructing WhatsAppSender above opens SQLite files but starts no threads.
+SUPERVISE = os.environ.get('SUPERVISOR', '1') == '1'
+SESSION_NAMES = [name.strip() for name in os.environ.get('WHATSAPP_SESSIONS', '').split(',') if name.strip()]
+session_pool = None
+if SESSION_NAMES:
+    session_pool = SessionPool(
+        SESSION_NAMES,
+        _session_sender,
+        routing=os.environ.get('SESSION_ROUTING', 'hash'),
+        supervise=SUPERVISE
+    )
+    session_pool.fork_workers()
+# Image workers are forked too, while this process is still single-threaded
+if whatsapp_sender.image_pipeline:
+    whatsapp_sender.image_pipeline.start()
+if session_pool is not None:
+    session_pool.start_readers()
+
+init_sentry()
+whatsapp_sender.check_ffmpeg()
+# Session workers connect on their own; a single session connects here
+if session_pool is None and os.environ.get('STARTUP_MODE', 'background') == 'blocking':
+    whatsapp_sender.initialize()
+elif session_pool is None:
+    # Bind the port straight away; the session connects in the background and /ready reports when it has
+    whatsapp_sender.start_warmup()
+if session_pool is None and SUPERVISE:
+    # Optional hot standby: a second logged-in session promoted the moment the primary drops
+    whatsapp_sender.start_supervisor(standby_session=os.environ.get('WHATSAPP_STANDBY_SESSION') or None)
+if session_pool is None:
+    whatsapp_sender.start_ack_polling()
+# Everything that actually sends goes through `sender`; whatsapp_sender keeps the local config and media cache
+sender = session_pool or whatsapp_sender
+
+# Pre-transcode videos as they land in video_dir so sends find a ready MP4 in the cache
+video_watcher = None
+if os.environ.get('PRETRANSCODE', '1') == '1' and whatsapp_sender.ffmpeg_available:
+    video_watcher = DirectoryWatcher(
+        whatsapp_sender.video_dir,
+        whatsapp_sender.video_extensions,
+        whatsapp_sender.pretranscode,
+        workers=int(os.environ.get('PRETRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+    )
+    video_watcher.start()
+
+# While the session warms up, direct sends wait this long before being queued (or rejected)
+WARMUP_WAIT_SECONDS = float(os.environ.get('WARMUP_WAIT_SECONDS', '2'))
+WARMUP_POLICY = os.environ.get('WARMUP_POLICY', 'queue')
+# Queued jobs are in no hurry, so they wait for the warm-up to finish
+JOB_WARMUP_WAIT_SECONDS = float(os.environ.get('JOB_WARMUP_WAIT_SECONDS', '120'))
+
+# Optimize images as they land in image_dir so sends only look up the cached derivative
+image_watcher = None
+if whatsapp_sender.image_pipeline:
+    image_watcher = DirectoryWatcher(
+        whatsapp_sender.image_dir,
+        IMAGE_EXTENSIONS,
+        whatsapp_sender.image_pipeline.derivative,
+        workers=whatsapp_sender.image_pipeline.workers
+    )
+    image_watcher.start()
+
+def ensure_initialized(timeout: float = WARMUP_WAIT_SECONDS) -> bool:
+    """Wait briefly for a connected session, starting the shared background warm-up if none is running."""
+    if sender.check_if_initialized():
+        return True
+    sentry_sdk.logger.info("WhatsApp client not initialized, waiting for warm-up")
+    sender.start_warmup()
+    return sender.wait_until_ready(timeout)
+
+def _run_text_job(job: Dict[str, any]) -> Dict[str, any]:
+    ensure_initialized(JOB_WARMUP_WAIT_SECONDS)
+    # Jobs report the final outcome, so a send that outlived its timeout is waited for rather than retried
+    return sender.settle(sender.send_message(job['phone_number'], job['message']))
+
+def _run_video_job(job: Dict[str, any]) -> Dict[str, any]:
+    ensure_initialized(JOB_WARMUP_WAIT_SECONDS)
+    return sender.settle(sender.send_video_file(job['phone_number'], job['file_path'], job.get('caption')))
+
+def _run_image_job(job: Dict[str, any]) -> Dict[str, any]:
+    ensure_initialized(JOB_WARMUP_WAIT_SECONDS)
+    return sender.settle(sender.send_image_file(job['phone_number'], job['file_path'], job.get('caption')))
+
+# Queued mode: sends are persisted to SQLite and drained by a worker pool
+SEND_QUEUE_DEFAULT = os.environ.get('SEND_QUEUE_DEFAULT', '0') == '1'
+send_queue = SendQueue(
+    handlers={'text': _run_text_job, 'video': _run_video_job, 'image': _run_image_job},
+    db_path=os.environ.get('SEND_QUEUE_DB', 'send_queue.db'),
+    workers=int(os.environ.get('SEND_QUEUE_WORKERS', '2'))
+)
+send_queue.start()
+
+def _replay_failure(failure: Dict[str, any]) -> Dict[str, any]:
+    if failure['kind'] == 'video':
+        result = sender.send_video_file(failure['phone_number'], failure['file_path'], failure['caption'], False)
+    else:
+        result = sender.send_image_file(failure['phone_number'], failure['file_path'], failure['caption'], False)
+    return sender.settle(result)
+
+# Failed sends are retried with backoff once the client is connected; old CSV rows are imported once
+failure_store = whatsapp_sender.failure_store
+failure_store.requeue_interrupted()
+if os.path.isfile('error_files.csv'):
+    failure_store.import_csv('error_files.csv')
+    os.replace('error_files.csv', f"error_files.csv.imported-{time.strftime('%Y%m%d-%H%M%S')}")
+failure_store.start_replay(_replay_failure, lambda: sender.check_if_initialized())
+
+def enqueue_send(kind: str, payload: Dict[str, any]):
+    job_id = send_queue.enqueue(kind, payload)
+    return jsonify({
+        'success': True,
+        'message': 'Queued',
+        'job_id': job_id,
+        'status_url': f'/jobs/{job_id}'
+    }), 202
+
+def warming_up(kind: str, payload: Optional[Dict[str, any]] = None):
+    """Answer a direct send that arrived before the session was ready: queue it, or fail fast with 503."""
+    if WARMUP_POLICY == 'queue' and payload is not None:
+        return enqueue_send(kind, payload)
+    body = {'success': False, 'message': 'WhatsApp client is warming up, retry shortly', **sender.readiness()}
+    return jsonify(body), 503, {'Retry-After': '5'}
+
+# Kiosks on flaky Wi-Fi retry POSTs; a retry replays the first reply instead of sending again.
+# Explicit Idempotency-Key headers are honoured for IDEMPOTENCY_TTL; without one, the same recipient,
+# content and caption within AUTO_DEDUPE_TTL count as a duplicate (0 turns automatic keys off).
+# Automatic keys cover media only: sending the same text twice is often deliberate.
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+AUTO_DEDUPE_TTL = float(os.environ.get('AUTO_DEDUPE_TTL', '600'))
+idempotency_cache = IdempotencyCache(
+    db_path=os.environ.get('IDEMPOTENCY_DB', 'idempotency.db'),
+    wait_timeout=whatsapp_sender.send_timeout * 4
+)
+
+def send_fingerprint(kind: str, phone_number: str, content: Optional[str], caption: Optional[str]) -> str:
+    parts = (kind, normalize_phone(phone_number), content or '', caption or '')
+    return hashlib.sha256(chr(0).join(parts).encode('utf-8')).hexdigest()
+
+def auto_key(kind: str, phone_number: str, content: Optional[str],
+             caption: Optional[str]) -> Optional[Tuple[str, float, str]]:
+    """(key, ttl, fingerprint) deduplicating a media send by recipient, content and caption."""
+    if kind == 'text' or AUTO_DEDUPE_TTL <= 0 or content is None:
+        return None
+    fingerprint = send_fingerprint(kind, phone_number, content, caption)
+    return f"{kind}:auto:{fingerprint}", AUTO_DEDUPE_TTL, fingerprint
+
+def idempotency_key(kind: str, data: Dict[str, any], phone_number: str, content: Optional[str],
+                    caption: Optional[str] = None) -> Optional[Tuple[str, float, str]]:
+    """(key, ttl, fingerprint) for a send: the Idempotency-Key header, else an automatic key for media.
+
+    The fingerprint hashes recipient, content and caption, so a header reused for another request is caught.
+    """
+    header = request.headers.get('Idempotency-Key')
+    if header:
+        return f"{kind}:key:{header}", IDEMPOTENCY_TTL, send_fingerprint(kind, phone_number, content, caption)
+    if data.get('dedupe') is False:
+        return None
+    return auto_key(kind, phone_number, content, caption)
+
+def file_content_key(file_path: str) -> Optional[str]:
+    # A missing file cannot be deduplicated; let the send report it
+    return whatsapp_sender.media_cache.source_digest(file_path) if os.path.isfile(file_path) else None
+
+def final_reply(body: Dict[str, any]) -> Optional[Future]:
+    """Future of the final (body, status) of a send replied to as in progress, else None."""
+    unfinished = sender.unfinished_send(body.get('send_id')) if body.get('in_progress') else None
+    if unfinished is None:
+        return None
+    reply = Future()
+
+    def finished(future: Future):
+        result = send_outcome(future)
+        reply.set_result((result, 200 if result.get('success') else 400))
+
+    unfinished.add_done_callback(finished)
+    return reply
+
+def idempotent(key: Optional[Tuple[str, float, str]], send: Callable[[], any]):
+    """Run send() once per key; duplicates get the stored (or in-flight) reply with Idempotent-Replayed set."""
+    if key is None:
+        return send()
+    responses = []
+
+    def reply():
+        responses.append(app.make_response(send()))
+        return responses[0].get_json(), responses[0].status_code
+
+    body, status, replayed = idempotency_cache.run(
+        key[0], key[1], key[2], reply, lambda body, status: status < 300 and bool(body.get('success')),
+        pending=final_reply
+    )
+    if responses:
+        return responses[0]
+    return jsonify(body), status, {'Idempotent-Replayed': 'true'} if replayed else {}
 
 @app.route('/send_message', methods=['POST'])
 def send_whatsapp_message():
-    if not whatsapp_sender.check_if_initialized():
-        sentry_sdk.logger.info("WhatsApp client not initialized, initializing now")
-        whatsapp_sender.initialize()
     """API endpoint to send a WhatsApp text message."""
     sentry_sdk.logger.info("Sending WhatsApp text message")
     try:
@@ -364,17 +1072,23 @@ def send_whatsapp_message():
         message = data.get('message')
         if not phone_number or not message:
             return jsonify({'success': False, 'message': 'phone_number and message are required'}), 400
-        result = whatsapp_sender.send_message(phone_number, message)
-        return jsonify(result)
+        payload = {'phone_number': phone_number, 'message': message}
+
+        def send():
+            if data.get('queued', SEND_QUEUE_DEFAULT):
+                return enqueue_send('text', payload)
+            if not ensure_initialized():
+                return warming_up('text', payload)
+            result = sender.send_message(phone_number, message)
+            return jsonify(result), 202 if result.get('in_progress') else 200
+
+        return idempotent(idempotency_key('text', data, phone_number, message), send)
     except Exception as e:
         capture_exception(e)
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
 
 @app.route('/send_video_file', methods=['POST'])
 def send_video_file():
-    if not whatsapp_sender.check_if_initialized():
-        sentry_sdk.logger.info("WhatsApp client not initialized, initializing now")
-        whatsapp_sender.initialize()
     """API endpoint to send a WhatsApp video file."""
     sentry_sdk.logger.info("Sending WhatsApp video file")
     try:
@@ -383,24 +1097,32 @@ def send_video_file():
             return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
         phone_number = data.get('phone_number')
         file_name = data.get('file_name')
-        whatsapp_sender.video_caption = data.get('caption', whatsapp_sender.default_caption)
+        caption = data.get('caption', whatsapp_sender.default_caption)
         if not phone_number or not file_name:
             return jsonify({'success': False, 'message': 'phone_number and file_name are required'}), 400
         file_path = os.path.join(whatsapp_sender.video_dir, file_name)
-        result = whatsapp_sender.send_video_file(phone_number, file_path)
-        if result.get("success"):
-            return jsonify(result)
-        else:
-            return jsonify(result), 400
+        payload = {'phone_number': phone_number, 'file_path': file_path, 'caption': caption}
+
+        def send():
+            if data.get('queued', SEND_QUEUE_DEFAULT):
+                return enqueue_send('video', payload)
+            if not ensure_initialized():
+                return warming_up('video', payload)
+            result = sender.send_video_file(phone_number, file_path, caption)
+            if result.get("success"):
+                return jsonify(result)
+            elif result.get("in_progress"):
+                return jsonify(result), 202
+            else:
+                return jsonify(result), 400
+
+        return idempotent(idempotency_key('video', data, phone_number, file_content_key(file_path), caption), send)
     except Exception as e:
         capture_exception(e)
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
 
 @app.route('/send_image_file', methods=['POST'])
 def send_image_file():
-    if not whatsapp_sender.check_if_initialized():
-        sentry_sdk.logger.info("WhatsApp client not initialized, initializing now")
-        whatsapp_sender.initialize()
     """API endpoint to send a WhatsApp image file."""
     try:
         data = request.get_json()
@@ -408,28 +1130,418 @@ def send_image_file():
             return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
         phone_number = data.get('phone_number')
         file_name = data.get('file_name')
-        whatsapp_sender.image_caption = data.get('caption', whatsapp_sender.default_caption)
+        caption = data.get('caption', whatsapp_sender.default_caption)
         if not phone_number or not file_name:
             return jsonify({'success': False, 'message': 'phone_number and file_name are required'}), 400
         file_path = os.path.join(whatsapp_sender.image_dir, file_name)
-        result = whatsapp_sender.send_image_file(phone_number, file_path)
-        if result.get("success"):
-            return jsonify(result)
+        payload = {'phone_number': phone_number, 'file_path': file_path, 'caption': caption}
+
+        def send():
+            if data.get('queued', SEND_QUEUE_DEFAULT):
+                return enqueue_send('image', payload)
+            if not ensure_initialized():
+                return warming_up('image', payload)
+            result = sender.send_image_file(phone_number, file_path, caption)
+            if result.get("success"):
+                return jsonify(result)
+            elif result.get("in_progress"):
+                return jsonify(result), 202
+            else:
+                return jsonify(result), 400
+
+        return idempotent(idempotency_key('image', data, phone_number, file_content_key(file_path), caption), send)
+    except Exception as e:
+        capture_exception(e)
+        return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
+
+def parse_recipients(raw) -> List[Dict[str, any]]:
+    """Normalise a recipient list of phone numbers and/or dicts; [] if any entry is unusable."""
+    if isinstance(raw, str):
+        raw = [r.strip() for r in raw.split(',') if r.strip()]
+    recipients = [{'phone_number': r} if isinstance(r, str) else r for r in raw or []]
+    if not all(isinstance(r, dict) and r.get('phone_number') for r in recipients):
+        return []
+    return recipients
+
+def deduplicated_batch(kind: str, recipients: List[Dict[str, any]], file_path: Optional[str],
+                       message: Optional[str], caption: Optional[str]) -> Iterator[Dict[str, any]]:
+    """iter_batch, minus recipients whose automatic key has a stored reply; those get it replayed.
+
+    Keys are the ones /send_video_file and /send_image_file use, so a retried batch or upload skips
+    recipients that already got the file, whichever route sent it.
+    """
+    content = file_content_key(file_path) if kind != 'text' else None
+    keys, pending = {}, []
+    for recipient in recipients:
+        key = auto_key(kind, recipient['phone_number'], content, recipient.get('caption', caption))
+        stored = idempotency_cache.replay(key[0], key[2]) if key else None
+        if stored is not None:
+            yield {'phone_number': recipient['phone_number'], **stored[0], 'replayed': True}
+            continue
+        if key:
+            keys[normalize_phone(recipient['phone_number'])] = key
+        pending.append(recipient)
+    if not pending:
+        return
+
+    def remember(key: Tuple[str, float, str], body: Dict[str, any], status: int):
+        if status < 300 and body.get('success'):
+            idempotency_cache.remember(key[0], key[1], key[2], body, status)
+
+    for result in sender.iter_batch(kind, pending, file_path, message, caption):
+        key = keys.get(normalize_phone(result['phone_number']))
+        final = final_reply(result) if key else None
+        if final is not None:
+            final.add_done_callback(lambda f, key=key: remember(key, *f.result()))
+        elif key:
+            remember(key, result, 200 if result.get('success') else 400)
+        yield result
+
+def batch_reply(kind: str, recipients: List[Dict[str, any]], file_path: Optional[str], message: Optional[str],
+                caption: Optional[str], stream: bool, extra: Optional[Dict[str, any]] = None, dedupe: bool = True):
+    """Send to every recipient and answer with per-recipient results, as one JSON body or as NDJSON lines."""
+    started = time.time()
+    if dedupe:
+        results = deduplicated_batch(kind, recipients, file_path, message, caption)
+    else:
+        results = sender.iter_batch(kind, recipients, file_path, message, caption)
+
+    def summary(sent: int, failed: int) -> Dict[str, any]:
+        elapsed = time.time() - started
+        return {
+            'success': failed == 0,
+            'sent': sent,
+            'failed': failed,
+            'seconds': round(elapsed, 3),
+            'recipients_per_minute': round((sent + failed) * 60 / elapsed, 1) if elapsed else None
+        }
+
+    if stream:
+        def generate():
+            if extra:
+                yield json.dumps(extra) + '\n'
+            counts = {True: 0, False: 0}
+            for result in results:
+                counts[bool(result.get('success'))] += 1
+                yield json.dumps(result) + '\n'
+            yield json.dumps({'summary': summary(counts[True], counts[False])}) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    collected = list(results)
+    sent = sum(1 for r in collected if r.get('success'))
+    body = {**(extra or {}), **summary(sent, len(collected) - sent), 'results': collected}
+    return jsonify(body), 200 if body['success'] else 207
+
+@app.route('/send_batch', methods=['POST'])
+def send_batch():
+    """API endpoint to send one message, video or image to many recipients."""
+    sentry_sdk.logger.info("Sending WhatsApp batch")
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'message': 'No JSON data provided'}), 400
+        kind = data.get('type', 'video')
+        if kind not in ('text', 'video', 'image'):
+            return jsonify({'success': False, 'message': 'type must be one of text, video, image'}), 400
+        recipients = parse_recipients(data.get('recipients'))
+        if not recipients:
+            return jsonify({'success': False, 'message': 'recipients must be a non-empty list of phone numbers'}), 400
+        file_path = None
+        message = data.get('message')
+        if kind == 'text':
+            if not message and not all(r.get('message') for r in recipients):
+                return jsonify({'success': False, 'message': 'message is required'}), 400
         else:
-            return jsonify(result), 400
+            file_name = data.get('file_name')
+            if not file_name:
+                return jsonify({'success': False, 'message': 'file_name is required'}), 400
+            directory = whatsapp_sender.video_dir if kind == 'video' else whatsapp_sender.image_dir
+            file_path = os.path.join(directory, file_name)
+        caption = data.get('caption', whatsapp_sender.default_caption)
+        if not ensure_initialized():
+            # Batches report per-recipient results, so they are never queued behind the warm-up
+            return warming_up(kind)
+        return batch_reply(kind, recipients, file_path, message, caption, bool(data.get('stream')),
+                           dedupe=data.get('dedupe') is not False)
+    except Exception as e:
+        capture_exception(e)
+        return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
+
+def claim_path(spool: SpoolFile, file_path: str) -> bool:
+    """Put the spool at file_path only if nothing is there yet; False if the name is taken."""
+    try:
+        # A hard link fails if the name exists, so two uploads can never both claim it
+        os.link(spool.path, file_path)
+    except FileExistsError:
+        return False
+    except OSError:
+        # No hard links (another filesystem): reserve the name exclusively, then copy into it
+        try:
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'wb') as target, open(spool.path, 'rb') as source:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+    spool.discard()
+    return True
+
+def store_upload(spool: SpoolFile, directory: str, file_name: str) -> str:
+    """Move a finished upload into directory. An identical file is reused; a different one is never overwritten."""
+    spool.close()
+    digest = spool.hexdigest()
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(file_name)
+    for name in (file_name, f"{stem}-{digest[:12]}{ext}", f"{stem}-{digest}{ext}"):
+        file_path = os.path.join(directory, name)
+        if claim_path(spool, file_path):
+            whatsapp_sender.media_cache.remember_digest(file_path, digest)
+            return file_path
+        if whatsapp_sender.media_cache.source_digest(file_path) == digest:
+            spool.discard()
+            return file_path
+    raise RuntimeError(f"No free name for upload {file_name}")
+
+@app.route('/upload', methods=['POST'])
+def upload_media():
+    """API endpoint that stores an uploaded video or image and optionally sends it in the same request."""
+    sentry_sdk.logger.info("Receiving media upload")
+    try:
+        if request.mimetype == 'multipart/form-data':
+            params = request.form
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({'success': False, 'message': 'file is required'}), 400
+            file_name = params.get('file_name') or upload.filename
+        else:
+            # Raw body: metadata travels in the query string so the body streams straight to disk
+            params = request.args
+            upload = None
+            file_name = params.get('file_name')
+        file_name = secure_filename(file_name or '')
+        extension = os.path.splitext(file_name)[1].lower()
+        kind = params.get('type') or (
+            'video' if extension in whatsapp_sender.video_extensions
+            else 'image' if extension in IMAGE_EXTENSIONS else None
+        )
+        extensions = whatsapp_sender.video_extensions if kind == 'video' else IMAGE_EXTENSIONS
+        if kind not in ('video', 'image') or extension not in extensions:
+            allowed = ', '.join((*whatsapp_sender.video_extensions, *IMAGE_EXTENSIONS))
+            return jsonify({'success': False, 'message': f'file_name must end in one of {allowed}'}), 400
+        raw_recipients = params.get('recipients')
+        if raw_recipients and raw_recipients.lstrip().startswith('['):
+            try:
+                raw_recipients = json.loads(raw_recipients)
+            except ValueError:
+                return jsonify({'success': False, 'message': 'recipients is not valid JSON'}), 400
+        recipients = parse_recipients(raw_recipients)
+        if raw_recipients and not recipients:
+            return jsonify({'success': False, 'message': 'recipients must be a list of phone numbers'}), 400
+        if upload is not None:
+            spool = upload.stream
+        else:
+            spool = spool_stream(request.stream, UPLOAD_SPOOL_DIR)
+            request.spools.append(spool)
+        details = {'type': kind, 'bytes': spool.size, 'sha256': spool.hexdigest()}
+        directory = whatsapp_sender.video_dir if kind == 'video' else whatsapp_sender.image_dir
+        file_path = store_upload(spool, directory, file_name)
+        details = {'upload': {'file_name': os.path.basename(file_path), **details}}
+        sentry_sdk.logger.info(f"Stored upload {file_path} ({spool.size} bytes)")
+
+        watcher = video_watcher if kind == 'video' else image_watcher
+        if not recipients or session_pool is None:
+            # Start conversion now; a send that needs it waits for the same work instead of repeating it
+            if watcher:
+                watcher.submit(file_path)
+        if not recipients:
+            return jsonify({'success': True, **details}), 201
+        if not ensure_initialized():
+            body = {
+                'success': False,
+                'message': 'Stored, but the WhatsApp client is warming up; send it with /send_batch shortly',
+                **details,
+                **sender.readiness()
+            }
+            return jsonify(body), 503, {'Retry-After': '5'}
+        if session_pool is not None:
+            # Convert once here so every session worker finds the result in the shared cache
+            if kind == 'video':
+                whatsapp_sender.pretranscode(file_path)
+            elif whatsapp_sender.image_pipeline:
+                whatsapp_sender.image_pipeline.derivative(file_path)
+        caption = params.get('caption', whatsapp_sender.default_caption)
+        stream = str(params.get('stream', '')).lower() in ('1', 'true', 'yes')
+        dedupe = str(params.get('dedupe', '')).lower() not in ('0', 'false', 'no')
+        return batch_reply(kind, recipients, file_path, None, caption, stream, details, dedupe)
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'message': f"Upload exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
     except Exception as e:
         capture_exception(e)
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """API endpoint to check the status of a queued send."""
+    job = send_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': f'Job not found: {job_id}'}), 404
+    return jsonify({'success': True, **job})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """API endpoint to check service health."""
     sentry_sdk.logger.info("Performing health check")
     return jsonify({
         'status': 'healthy',
-        'whatsapp_initialized': whatsapp_sender.check_if_initialized()
+        'whatsapp_initialized': sender.check_if_initialized(),
+        'send_queue': {'depth': send_queue.depth(), **send_queue.stats()},
+        'media_cache': whatsapp_sender.media_cache.stats(),
+        'acks': whatsapp_sender.ack_tracker.stats(),
+        'idempotency': idempotency_cache.stats(),
+        'image_pipeline': whatsapp_sender.image_pipeline.stats() if whatsapp_sender.image_pipeline else None,
+        'sessions': session_pool.stats() if session_pool else None,
+        'scheduler': None if session_pool else whatsapp_sender.scheduler.stats(),
+        'supervisor': None if session_pool or not whatsapp_sender.supervisor else whatsapp_sender.supervisor.stats()
     })
 
+@app.route('/acks/<path:message_id>', methods=['GET'])
+def get_ack(message_id):
+    """API endpoint reporting the latest delivery ack of a sent message."""
+    record = whatsapp_sender.ack_tracker.get(message_id)
+    if record is None:
+        return jsonify({'success': False, 'message': f'Message not found: {message_id}'}), 404
+    return jsonify({'success': True, **record})
+
+@app.route('/acks', methods=['GET'])
+def list_acks():
+    """API endpoint listing tracked messages, filterable by phone number and ack status."""
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    messages = whatsapp_sender.ack_tracker.query(
+        phone_number=request.args.get('phone_number'),
+        status=request.args.get('status'),
+        limit=limit
+    )
+    return jsonify({'success': True, **whatsapp_sender.ack_tracker.stats(), 'messages': messages})
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once a WhatsApp session is connected, 503 while warming up."""
+    readiness = sender.readiness()
+    return jsonify(readiness), 200 if readiness['ready'] else 503
+
+@app.route('/failures', methods=['GET'])
+def list_failures():
+    """API endpoint to look up recorded send failures."""
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    failures = failure_store.query(
+        phone_number=request.args.get('phone_number'),
+        status=request.args.get('status'),
+        limit=limit
+    )
+    return jsonify({'success': True, 'counts': failure_store.stats(), 'failures': failures})
+
+@app.route('/failures/import', methods=['POST'])
+def import_failures():
+    """API endpoint to import rows from a legacy error CSV, posted as the body or named by csv_path."""
+    try:
+        if request.mimetype == 'text/csv':
+            return jsonify({'success': True, 'imported': failure_store.import_text(request.get_data(as_text=True))})
+        data = request.get_json(silent=True) or {}
+        csv_path = data.get('csv_path', 'error_files.csv')
+        # Only files under the working directory; this must not read arbitrary server files
+        root = os.path.realpath(os.getcwd())
+        if os.path.commonpath([root, os.path.realpath(csv_path)]) != root:
+            return jsonify({'success': False, 'message': 'csv_path must be inside the working directory'}), 403
+        if not os.path.isfile(csv_path):
+            return jsonify({'success': False, 'message': f'File not found: {csv_path}'}), 404
+        imported = failure_store.import_csv(csv_path)
+        return jsonify({'success': True, 'imported': imported})
+    except Exception as e:
+        capture_exception(e)
+        return jsonify({'success': False, 'message': f'Import error: {str(e)}'}), 500
+
+def _read_queue_depth() -> Dict[Tuple[str, ...], float]:
+    depths = {('send_queue',): send_queue.depth()}
+    if session_pool is None:
+        for lane, stats in whatsapp_sender.scheduler.stats()['lanes'].items():
+            depths[(f'scheduler_{lane}',)] = stats['depth']
+    return depths
+
+def _read_in_flight() -> Dict[Tuple[str, ...], float]:
+    if session_pool is not None:
+        return {(s['name'],): s['in_flight'] for s in session_pool.stats()}
+    return {(whatsapp_sender.session,): whatsapp_sender.in_flight}
+
+if session_pool is not None:
+    # Sends run in the session workers, so their counters and stage timings are merged in here
+    metrics.registry.merge_remote(session_pool.metric_snapshots)
+metrics.registry.gauge('whatsapp_queue_depth', 'Sends waiting in each queue', _read_queue_depth, labels=('queue',))
+metrics.registry.gauge('whatsapp_in_flight', 'Sends currently running per session', _read_in_flight, labels=('session',))
+metrics.registry.gauge(
+    'whatsapp_media_cache', 'Media cache counters and sizes',
+    lambda: {(k,): v for k, v in whatsapp_sender.media_cache.stats().items()}, labels=('counter',)
+)
+metrics.registry.gauge(
+    'whatsapp_image_pipeline', 'Image pipeline counters: images processed, bytes in and out, seconds spent',
+    lambda: {(k,): v for k, v in whatsapp_sender.image_pipeline.stats().items() if v is not None}
+    if whatsapp_sender.image_pipeline else {},
+    labels=('counter',)
+)
+metrics.registry.gauge(
+    'whatsapp_messages_by_ack', 'Tracked messages by latest ack status',
+    lambda: {(k,): v for k, v in whatsapp_sender.ack_tracker.stats()['counts'].items()}, labels=('status',)
+)
+metrics.registry.gauge(
+    'whatsapp_failures', 'Recorded failures by status',
+    lambda: {(k,): v for k, v in failure_store.stats().items()}, labels=('status',)
+)
+metrics.registry.gauge(
+    'whatsapp_connected', 'Whether a WhatsApp session is connected',
+    lambda: {(): int(sender.check_if_initialized())}
+)
+
+def _read_supervisor() -> Dict[Tuple[str, ...], float]:
+    if session_pool is not None:
+        supervisors = {s['name']: s['supervisor'] for s in session_pool.stats() if s['supervisor']}
+    elif whatsapp_sender.supervisor:
+        supervisors = {whatsapp_sender.session: whatsapp_sender.supervisor.stats()}
+    else:
+        supervisors = {}
+    return {
+        (name, key): float(stats[key])
+        for name, stats in supervisors.items()
+        for key in ('disconnects', 'reconnects', 'reconnect_failures', 'promotions', 'downtime_seconds')
+    }
+
+metrics.registry.gauge(
+    'whatsapp_supervisor', 'Connection supervisor counters and cumulative downtime per session',
+    _read_supervisor, labels=('session', 'counter')
+)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of in-process metrics."""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    """API endpoint reporting load and health of each WhatsApp session."""
+    if session_pool is None:
+        return jsonify({
+            'routing': None,
+            'sessions': [{
+                'name': whatsapp_sender.session,
+                'healthy': whatsapp_sender.check_if_initialized(),
+                'supervisor': whatsapp_sender.supervisor.stats() if whatsapp_sender.supervisor else None
+            }]
+        })
+    return jsonify({'routing': session_pool.routing, 'sessions': session_pool.stats()})
+
 @app.route('/', methods=['GET'])
 def home():
     """API root endpoint with available endpoints information."""
@@ -440,10 +1552,18 @@ def home():
             'send_message': 'POST /send_message - {"phone_number": "+97466549299", "message": "Hello!"}',
             'send_video_file': 'POST /send_video_file - {"phone_number": "+97466549299", "file_name": "video.mp4", "caption": "Optional caption"}',
             'send_image_file': 'POST /send_image_file - {"phone_number": "+97466549299", "file_name": "image.jpg", "caption": "Optional caption"}',
+            'send_batch': 'POST /send_batch - {"type": "video", "file_name": "video.mp4", "recipients": ["+97466549299", {"phone_number": "+97466549300", "caption": "Optional"}], "stream": false}',
+            'upload': 'POST /upload - multipart "file" (+ optional "recipients", "caption", "stream") or a raw body with ?file_name=...&recipients=...',
+            'jobs': 'GET /jobs/<job_id> - status of a send made with "queued": true',
             'health': 'GET /health',
+            'ready': 'GET /ready - 200 once a WhatsApp session is connected, 503 while warming up',
+            'metrics': 'GET /metrics',
+            'sessions': 'GET /sessions',
+            'failures': 'GET /failures?phone_number=97466549299&status=pending',
+            'acks': 'GET /acks/<message_id> or GET /acks?phone_number=97466549299&status=delivered',
             'initialize': 'POST /initialize'
         },
-        'initialized': whatsapp_sender.check_if_initialized()
+        'initialized': sender.check_if_initialized()
     })
 
 @app.route('/initialize', methods=['POST'])
@@ -451,9 +1571,9 @@ def initialize_whatsapp():
     """API endpoint to initialize WhatsApp client."""
     sentry_sdk.logger.info("Initializing WhatsApp client via API")
     try:
-        if whatsapp_sender.check_if_initialized():
+        if sender.check_if_initialized():
             return jsonify({'success': True, 'message': 'Already initialized'})
-        result = whatsapp_sender.initialize()
+        result = sender.initialize()
         if result.get("success"):
             return jsonify(result)
         else:
@@ -467,4 +1587,12 @@ if __name__ == '__main__':
         app.run(debug=False, host='127.0.0.1', port=5000, use_reloader=False)
         sentry_sdk.logger.info("Flask app started on http://127.0.0.1:5000")
     finally:
+        send_queue.stop()
+        failure_store.stop()
+        if video_watcher:
+            video_watcher.stop()
+        if image_watcher:
+            image_watcher.stop()
+        if session_pool:
+            session_pool.close()
         whatsapp_sender.close()
\ No newline at end of file
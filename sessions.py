@@ -0,0 +1,370 @@
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from typing import Callable, Dict, Iterator, List, Optional
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+import metrics
+from scheduler import UnfinishedSends, in_progress
+
+
+def _session_worker(name: str, sender_factory: Callable[[str], any], requests, responses,
+                    heartbeat_interval: float, supervise: bool):
+    """Worker process main: own one WhatsAppSender and serve send calls for it."""
+    sender = sender_factory(name)
+    sender.check_ffmpeg()
+    sender.initialize()
+    if supervise:
+        sender.start_supervisor()
+    sender.start_ack_polling()
+
+    def health() -> Dict[str, any]:
+        return {
+            'connected': sender.check_if_initialized(),
+            'scheduler': sender.scheduler.stats(),
+            'supervisor': sender.supervisor.stats() if sender.supervisor else None,
+            # Stage timings and send counters live in this process; the parent adds them to /metrics
+            'metrics': metrics.registry.snapshot()
+        }
+
+    def serve(request_id: int, method: str, args: tuple):
+        try:
+            # With a supervisor, sends wait out its reconnect instead of each starting a login
+            if sender.supervisor is None and not sender.check_if_initialized():
+                sender.initialize()
+            result = getattr(sender, method)(*args)
+        except Exception as e:
+            capture_exception(e)
+            result = {'success': False, 'message': f'Error: {str(e)}'}
+        responses.put(('result', request_id, result))
+        responses.put(('health', None, health()))
+        if isinstance(result, dict) and result.get('in_progress'):
+            # The caller was told the send is still going; report how it really ends
+            responses.put(('finished', result['send_id'], sender.settle(result)))
+
+    # Calls block until their send finishes, so serve them concurrently and let the
+    # sender's scheduler decide what actually runs
+    executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix=f"session-{name}")
+    last_heartbeat = 0.0
+    while True:
+        # Heartbeat on a clock, not only when idle, so a busy worker never looks stale to the parent
+        if time.monotonic() - last_heartbeat >= heartbeat_interval:
+            responses.put(('health', None, health()))
+            last_heartbeat = time.monotonic()
+        try:
+            item = requests.get(timeout=heartbeat_interval)
+        except queue.Empty:
+            continue
+        if item is None:
+            break
+        executor.submit(serve, *item)
+    executor.shutdown(wait=True)
+    sender.close()
+
+
+class _Session:
+    def __init__(self, name: str, stale_after: float):
+        self.name = name
+        self.stale_after = stale_after
+        self.process = None
+        self.requests = None
+        self.responses = None
+        self.reader = None
+        self.pending: Dict[int, tuple] = {}
+        self.connected = False
+        self.last_seen = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.failovers = 0
+        self.scheduler = None
+        self.supervisor = None
+        self.metrics = None
+        # send_id -> Future for sends this worker reported as in progress, resolved by its 'finished' message
+        self.unfinished: Dict[str, Future] = {}
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def is_healthy(self) -> bool:
+        # A worker that has missed several heartbeats may be wedged even though its process is up
+        return self.is_alive() and self.connected and time.time() - self.last_seen < self.stale_after
+
+
+class SessionPool:
+    """Run several named WhatsApp sessions in worker processes and route sends between them."""
+
+    def __init__(self, session_names: List[str], sender_factory: Callable[[str], any],
+                 routing: str = 'hash', virtual_nodes: int = 64, timeout: float = 120.0,
+                 heartbeat_interval: float = 5.0, supervise: bool = True):
+        if routing not in ('hash', 'least_loaded'):
+            raise ValueError(f"Unknown routing strategy: {routing}")
+        self.sender_factory = sender_factory
+        self.routing = routing
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.supervise = supervise
+        self.sessions = {name: _Session(name, stale_after=heartbeat_interval * 3) for name in session_names}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self.unfinished = UnfinishedSends()
+        self._stopping = False
+        # Fork so workers inherit the already-imported app without re-running its startup
+        self._context = multiprocessing.get_context('fork')
+        self._ring = sorted(
+            (self._hash(f"{name}#{i}"), name)
+            for name in session_names for i in range(virtual_nodes)
+        )
+        self._ring_keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def start(self):
+        self.fork_workers()
+        self.start_readers()
+
+    def fork_workers(self):
+        """Fork one worker per session; anything else that forks should do so before start_readers()."""
+        sentry_sdk.logger.info(f"Starting {len(self.sessions)} WhatsApp session workers")
+        for session in self.sessions.values():
+            session.requests = self._context.Queue()
+            session.responses = self._context.Queue()
+            session.process = self._context.Process(
+                target=_session_worker,
+                args=(session.name, self.sender_factory, session.requests, session.responses,
+                      self.heartbeat_interval, self.supervise),
+                name=f"session-{session.name}",
+                daemon=True
+            )
+            session.process.start()
+
+    def start_readers(self):
+        for session in self.sessions.values():
+            session.reader = threading.Thread(target=self._read_responses, args=(session,),
+                                              name=f"session-reader-{session.name}", daemon=True)
+            session.reader.start()
+
+    def close(self):
+        self._stopping = True
+        for session in self.sessions.values():
+            if session.is_alive():
+                session.requests.put(None)
+        for session in self.sessions.values():
+            if session.process:
+                session.process.join(timeout=10)
+                if session.process.is_alive():
+                    session.process.terminate()
+
+    def _read_responses(self, session: _Session):
+        while not self._stopping:
+            try:
+                kind, request_id, value = session.responses.get(timeout=1.0)
+            except queue.Empty:
+                if not session.is_alive():
+                    self._fail_over(session)
+                    return
+                continue
+            session.last_seen = time.time()
+            if kind == 'health':
+                if session.connected != value['connected']:
+                    sentry_sdk.logger.info(f"Session {session.name} connected={value['connected']}")
+                session.connected = value['connected']
+                session.scheduler = value['scheduler']
+                session.supervisor = value['supervisor']
+                session.metrics = value['metrics']
+                continue
+            if kind == 'finished':
+                with self._lock:
+                    source = session.unfinished.pop(request_id, None)
+                if source is not None:
+                    source.set_result(value)
+                continue
+            if value and value.get('in_progress'):
+                # Registered before the caller sees the reply, so settle() can always find it
+                source = Future()
+                with self._lock:
+                    session.unfinished[value['send_id']] = source
+                self.unfinished.add(source, send_id=value['send_id'])
+            with self._lock:
+                entry = session.pending.pop(request_id, None)
+            if entry is None:
+                continue
+            future = entry[0]
+            if value and value.get('success'):
+                session.sent += 1
+            else:
+                session.failed += 1
+            future.set_result(value)
+
+    def _fail_over(self, session: _Session):
+        """Move requests stranded on a dead worker to the next healthy session."""
+        session.connected = False
+        with self._lock:
+            stranded = list(session.pending.values())
+            session.pending.clear()
+            unfinished = list(session.unfinished.values())
+            session.unfinished.clear()
+        for source in unfinished:
+            source.set_result({'success': False, 'message': 'Session worker exited before the send finished'})
+        sentry_sdk.logger.error(f"Session {session.name} exited; failing over {len(stranded)} requests")
+        for future, phone_number, method, args in stranded:
+            session.failovers += 1
+            self._dispatch(future, phone_number, method, args, exclude={session.name})
+
+    def _route(self, phone_number: str, exclude=frozenset()) -> Optional[_Session]:
+        candidates = [s for s in self.sessions.values() if s.name not in exclude and s.is_alive()]
+        # Sessions that dropped their connection inside a live worker are skipped while any other is healthy;
+        # if none is, requests go to a live worker, which holds them while its supervisor reconnects
+        healthy = [s for s in candidates if s.is_healthy()] or candidates
+        if not healthy:
+            return None
+        if self.routing == 'least_loaded':
+            return min(healthy, key=lambda s: len(s.pending))
+        allowed = {s.name for s in healthy}
+        start = bisect.bisect(self._ring_keys, self._hash(phone_number))
+        for i in range(len(self._ring)):
+            name = self._ring[(start + i) % len(self._ring)][1]
+            if name in allowed:
+                return self.sessions[name]
+        return None
+
+    def _dispatch(self, future: Future, phone_number: str, method: str, args: tuple, exclude=frozenset()):
+        session = self._route(phone_number, exclude)
+        if session is None:
+            future.set_result({'success': False, 'message': 'No healthy WhatsApp session available'})
+            return
+        request_id = next(self._ids)
+        with self._lock:
+            session.pending[request_id] = (future, phone_number, method, args)
+        session.requests.put((request_id, method, args))
+
+    def submit(self, phone_number: str, method: str, *args) -> Future:
+        future = Future()
+        self._dispatch(future, phone_number.replace('+', ''), method, (phone_number, *args))
+        return future
+
+    def _final(self, future: Future) -> Future:
+        """Future of a request's final result, following an in-progress reply until that send ends."""
+        final = Future()
+
+        def done(request: Future):
+            result = request.result()
+            unfinished = self.unfinished.get(result.get('send_id')) if result and result.get('in_progress') else None
+            if unfinished is None:
+                final.set_result(result)
+            else:
+                unfinished.add_done_callback(lambda send: final.set_result(send.result()))
+
+        future.add_done_callback(done)
+        return final
+
+    def unfinished_send(self, send_id: Optional[str]) -> Optional[Future]:
+        return self.unfinished.get(send_id)
+
+    def settle(self, result: Optional[Dict[str, any]], timeout: Optional[float] = None) -> Optional[Dict[str, any]]:
+        return self.unfinished.settle(result, timeout)
+
+    def _call(self, phone_number: str, method: str, *args) -> Dict[str, any]:
+        future = self.submit(phone_number, method, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            # The worker may still be sending; do not report a failure that would be retried
+            return in_progress(self.unfinished.add(self._final(future)))
+        except Exception as e:
+            capture_exception(e)
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def send_message(self, phone_number: str, message: str) -> Dict[str, any]:
+        return self._call(phone_number, 'send_message', message)
+
+    def send_video_file(self, phone_number: str, file_path: str, caption: Optional[str] = None,
+                        record_failures: bool = True) -> Dict[str, any]:
+        return self._call(phone_number, 'send_video_file', file_path, caption, record_failures)
+
+    def send_image_file(self, phone_number: str, file_path: str, caption: Optional[str] = None,
+                        record_failures: bool = True) -> Dict[str, any]:
+        return self._call(phone_number, 'send_image_file', file_path, caption, record_failures)
+
+    def iter_batch(self, kind: str, recipients: List[Dict[str, any]], file_path: Optional[str] = None,
+                   message: Optional[str] = None, caption: Optional[str] = None) -> Iterator[Dict[str, any]]:
+        """Spread a batch across sessions and yield results as they complete."""
+        futures = {}
+        for recipient in recipients:
+            phone_number = recipient['phone_number']
+            if kind == 'text':
+                future = self.submit(phone_number, 'send_message', recipient.get('message', message))
+            else:
+                method = 'send_video_file' if kind == 'video' else 'send_image_file'
+                future = self.submit(phone_number, method, file_path, recipient.get('caption', caption))
+            futures[future] = phone_number
+        yielded = set()
+        try:
+            for future in as_completed(futures, timeout=self.timeout * max(1, len(recipients))):
+                yielded.add(future)
+                yield {'phone_number': futures[future], **future.result()}
+        except FuturesTimeoutError:
+            # Report every recipient instead of cutting the batch (or its NDJSON stream) short
+            for future, phone_number in futures.items():
+                if future in yielded:
+                    continue
+                result = future.result() if future.done() else in_progress(self.unfinished.add(self._final(future)))
+                yield {'phone_number': phone_number, **result}
+
+    def metric_snapshots(self) -> List[Dict[str, any]]:
+        """Latest metrics snapshot reported by each worker (cumulative since that worker started)."""
+        return [s.metrics for s in self.sessions.values() if s.metrics]
+
+    def check_if_initialized(self) -> bool:
+        return any(s.is_healthy() for s in self.sessions.values())
+
+    def initialize(self) -> Dict[str, any]:
+        # Workers connect on their own; report whether any is usable yet
+        if self.check_if_initialized():
+            return {'success': True, 'message': 'Initialization successful'}
+        return {'success': False, 'message': 'No WhatsApp session connected yet'}
+
+    def start_warmup(self):
+        # Each worker connects its own session as soon as it starts
+        pass
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.check_if_initialized():
+            if time.monotonic() >= deadline or not any(s.is_alive() for s in self.sessions.values()):
+                return False
+            time.sleep(0.1)
+        return True
+
+    def readiness(self) -> Dict[str, any]:
+        ready = self.check_if_initialized()
+        return {
+            'ready': ready,
+            'state': 'ready' if ready else 'warming',
+            'sessions': {s.name: s.is_healthy() for s in self.sessions.values()}
+        }
+
+    def stats(self) -> List[Dict[str, any]]:
+        return [{
+            'name': s.name,
+            'pid': s.process.pid if s.process else None,
+            'alive': s.is_alive(),
+            'connected': s.connected,
+            'healthy': s.is_healthy(),
+            'in_flight': len(s.pending),
+            'sent': s.sent,
+            'failed': s.failed,
+            'failovers': s.failovers,
+            'last_seen': s.last_seen,
+            'scheduler': s.scheduler,
+            'supervisor': s.supervisor,
+        } for s in self.sessions.values()]
@@ -0,0 +1,156 @@
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import sentry_sdk
+import sentry_sdk.logger
+from sentry_sdk import capture_exception
+
+import metrics
+
+reconnects_total = metrics.registry.counter(
+    'whatsapp_reconnects_total', 'Reconnect attempts by outcome', labels=('session', 'outcome')
+)
+
+# States WhatsApp Web does not leave on its own; anything else (OPENING, PAIRING, TIMEOUT...) gets a grace period
+TERMINAL_STATES = ('CLOSED', 'CONFLICT', 'UNPAIRED', 'UNPAIRED_IDLE')
+
+
+class ConnectionSupervisor:
+    """Watch a WhatsAppSender's connection, reconnect it with backoff and keep an optional standby warm.
+
+    The sender provides `_connected()`, `connection_state()`, `initializing()`, `reconnect()`,
+    `connect_standby(name)`, `standby_connected()` and `promote_standby()`. Reconnects go through the
+    sender's single-flight initialize, so a burst of sends after a disconnect never starts more than one login.
+    Transient states are left to WPP's own re-login for `grace` seconds before the supervisor steps in.
+    """
+
+    def __init__(self, sender, interval: float = 2.0, base_delay: float = 2.0, max_delay: float = 60.0,
+                 standby_session: Optional[str] = None, grace: float = 20.0):
+        self.sender = sender
+        self.interval = interval
+        self.grace = grace
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.standby_session = standby_session
+        self.reconnecting = False
+        self.disconnects = 0
+        self.reconnects = 0
+        self.reconnect_failures = 0
+        self.promotions = 0
+        self.downtime_total = 0.0
+        self.down_since: Optional[float] = None
+        self.ever_connected = False
+        self._unhealthy_since: Optional[float] = None
+        self._failures_in_row = 0
+        self._next_attempt_at = 0.0
+        self._standby_thread = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        sentry_sdk.logger.info(f"Starting connection supervisor for session {self.sender.session}")
+        self.ever_connected = self.ever_connected or self.sender._connected()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name=f"supervisor-{self.sender.session}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                capture_exception(e)
+
+    def _backoff(self) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** self._failures_in_row))
+        return delay * random.uniform(0.5, 1.5)
+
+    def check(self):
+        """One supervision pass: record state changes, then promote the standby or reconnect if due."""
+        now = time.time()
+        if self.sender._connected():
+            if self.down_since is not None:
+                downtime = now - self.down_since
+                self.downtime_total += downtime
+                self.down_since = None
+                sentry_sdk.logger.info(f"Session {self.sender.session} back after {downtime:.1f}s")
+            self.ever_connected = True
+            self._unhealthy_since = None
+            self._failures_in_row = 0
+            self._ensure_standby()
+            return
+        if self._unhealthy_since is None:
+            self._unhealthy_since = now
+        # Before the first login there is no session to lose, so a failed warm-up is not downtime
+        if self.ever_connected and self.down_since is None:
+            self.down_since = now
+            self.disconnects += 1
+            sentry_sdk.logger.error(f"Session {self.sender.session} disconnected ({self.sender.connection_state()})")
+        if self.sender.initializing():
+            # The startup warm-up or another caller is already logging in
+            return
+        if self.sender.connection_state() not in TERMINAL_STATES and now - self._unhealthy_since < self.grace:
+            # WPP re-logs in by itself from transient states; a reconnect now would only cut across it
+            return
+        if self.sender.standby_connected():
+            self._promote()
+            return
+        if now < self._next_attempt_at:
+            return
+        self.reconnecting = True
+        try:
+            result = self.sender.reconnect()
+        finally:
+            self.reconnecting = False
+        if result.get('success'):
+            self.reconnects += 1
+            reconnects_total.inc(1, self.sender.session, 'success')
+            return
+        self.reconnect_failures += 1
+        reconnects_total.inc(1, self.sender.session, 'failure')
+        self._next_attempt_at = time.time() + self._backoff()
+        self._failures_in_row += 1
+
+    def _promote(self):
+        old_session = self.sender.promote_standby()
+        self.promotions += 1
+        reconnects_total.inc(1, self.sender.session, 'promoted')
+        sentry_sdk.logger.warning(f"Promoted standby session {self.sender.session} over {old_session}")
+        # The old primary logs back in as the new standby
+        self.standby_session = old_session
+
+    def _ensure_standby(self):
+        if not self.standby_session or self.sender.standby_connected():
+            return
+        if self._standby_thread and self._standby_thread.is_alive():
+            return
+        self._standby_thread = threading.Thread(
+            target=self.sender.connect_standby, args=(self.standby_session,),
+            name=f"standby-{self.standby_session}", daemon=True
+        )
+        self._standby_thread.start()
+
+    def stats(self) -> Dict[str, any]:
+        downtime = self.downtime_total + (time.time() - self.down_since if self.down_since else 0.0)
+        return {
+            'connected': self.sender._connected(),
+            'state': self.sender.connection_state(),
+            'reconnecting': self.reconnecting,
+            'disconnects': self.disconnects,
+            'reconnects': self.reconnects,
+            'reconnect_failures': self.reconnect_failures,
+            'promotions': self.promotions,
+            'downtime_seconds': round(downtime, 1),
+            'standby_session': self.standby_session,
+            'standby_connected': self.sender.standby_connected()
+        }